@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+# Benchmarks for proof.py that run without touching Wikipedia. Histories are
+# generated locally and served by a stub wiki, and results are printed as
+# JSON so runs can be compared against each other.
+
+import os
+import os.path
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import gzip
+import hashlib
+import http.server
+import io
+import json
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from xml.sax.saxutils import escape
+
+import proof
+
+BENCH_TITLE = 'Benchmark page'
+BENCH_PAGE_ID = '4242'
+BENCH_WORDS = [
+    'alpha', 'beta', 'gamma', 'delta', 'épsilon', '[[link]]', '{{template}}',
+    '<ref>source</ref>', '\n', '==Heading==', '\'\'\'bold\'\'\'', '*',
+]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark wikimit against a local stub wiki.')
+    parser.add_argument('--revisions', type=int, default=1000,
+                        help='revisions in the generated history')
+    parser.add_argument('--text-kb', type=float, default=20,
+                        help='approximate article size in KB')
+    parser.add_argument('--users', type=int, default=50,
+                        help='distinct registered contributors')
+    parser.add_argument('--ip-fraction', type=float, default=0.3,
+                        help='fraction of edits made by IP contributors')
+    parser.add_argument('--revert-fraction', type=float, default=0.05,
+                        help='fraction of edits that revert to an earlier text')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--gzip', action='store_true',
+                        help='have the stub wiki compress responses')
+    parser.add_argument('--only', action='append', choices=sorted(BENCHMARKS),
+                        help='run only this benchmark, can be repeated')
+    parser.add_argument('--output', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show what proof.py prints while running')
+    args = parser.parse_args()
+
+    os.environ.setdefault('GIT_AUTHOR_NAME', 'wikimit-bench')
+    os.environ.setdefault('GIT_AUTHOR_EMAIL', 'bench@localhost')
+    os.environ.setdefault('GIT_COMMITTER_NAME', 'wikimit-bench')
+    os.environ.setdefault('GIT_COMMITTER_EMAIL', 'bench@localhost')
+
+    revisions = generate_revisions(
+        count=args.revisions,
+        text_size=int(args.text_kb * 1024),
+        users=args.users,
+        ip_fraction=args.ip_fraction,
+        revert_fraction=args.revert_fraction,
+        seed=args.seed)
+    wiki = StubWiki(BENCH_TITLE, BENCH_PAGE_ID, revisions, compress=args.gzip)
+    names = args.only or sorted(BENCHMARKS)
+    results = []
+    try:
+        for name in names:
+            results.append(run_isolated(name, wiki, args.verbose))
+    finally:
+        wiki.close()
+
+    report = {
+        'config': {
+            'revisions': args.revisions,
+            'text_kb': args.text_kb,
+            'users': args.users,
+            'ip_fraction': args.ip_fraction,
+            'revert_fraction': args.revert_fraction,
+            'seed': args.seed,
+            'gzip': args.gzip,
+            'export_mb': round(len(wiki.export()) / 1e6, 3),
+            'python': sys.version.split()[0],
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with io.open(args.output, 'w', encoding='utf8') as file:
+            file.write(text + '\n')
+
+# generate
+
+def generate_revisions(count, text_size, users, ip_fraction, revert_fraction, seed):
+    # Returns [(timestamp, revision xml)] for a page that grows by small
+    # edits, with some edits reverting to one of the last few texts.
+    rnd = random.Random(seed)
+    text = ' '.join(rnd.choice(BENCH_WORDS) for _ in range(text_size // 7))
+    history = []
+    revisions = []
+    start = datetime.datetime(2001, 1, 15)
+    for index in range(count):
+        if history and rnd.random() < revert_fraction:
+            text = rnd.choice(history[-5:])
+        else:
+            pos = rnd.randrange(len(text) + 1)
+            text = text[:pos] + ' ' + rnd.choice(BENCH_WORDS) + text[pos:]
+        history.append(text)
+        timestamp = (start + datetime.timedelta(minutes=17 * index)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        if rnd.random() < ip_fraction:
+            contributor = '<ip>10.{}.{}.{}</ip>'.format(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+        else:
+            user = rnd.randrange(max(users, 1))
+            contributor = '<username>User {}</username><id>{}</id>'.format(user, 1000 + user)
+        revisions.append((timestamp, revision_xml(index, timestamp, contributor, text, rnd)))
+    return revisions
+
+def revision_xml(index, timestamp, contributor, text, rnd):
+    comment = '<comment>Edit {} /* section */ tweak</comment>'.format(index) if rnd.random() < 0.8 else ''
+    minor = '<minor />' if rnd.random() < 0.2 else ''
+    data = text.encode('utf8')
+    return (
+        '<revision><id>{}</id><parentid>{}</parentid><timestamp>{}</timestamp>'
+        '<contributor>{}</contributor>{}{}<model>wikitext</model><format>text/x-wiki</format>'
+        '<text bytes="{}" xml:space="preserve">{}</text><sha1>{}</sha1></revision>'
+    ).format(
+        100000 + index, 99999 + index, timestamp, contributor, minor, comment,
+        len(data), escape(text), hashlib.sha1(data).hexdigest())
+
+def export_xml(title, page_id, revisions):
+    return (
+        '<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" version="0.10" xml:lang="en">'
+        '<siteinfo><sitename>Wikipedia</sitename></siteinfo>'
+        '<page><title>{}</title><ns>0</ns><id>{}</id>{}</page></mediawiki>'
+    ).format(escape(title), page_id, ''.join(revisions)).encode('utf8')
+
+# stub wiki
+
+class StubWiki:
+    # Answers Special:Export the way proof.download_history calls it, from a
+    # thread in this process. Benchmarks run in a child process so the
+    # server doesn't compete with them for the interpreter.
+
+    def __init__(self, title, page_id, revisions, compress=False):
+        self.title = title
+        self.page_id = page_id
+        self.revisions = revisions
+        self.compress = compress
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.base = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def export(self, offset=None, limit=None, current=False):
+        # Special:Export offsets are the timestamp of the last revision seen.
+        if current:
+            selected = self.revisions[-1:]
+        else:
+            selected = [item for item in self.revisions if offset is None or item[0] > offset]
+            selected = selected[:limit] if limit else selected
+        return export_xml(self.title, self.page_id, [xml for timestamp, xml in selected])
+
+    def handler(self):
+        wiki = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf8') if length else ''
+                query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+                query.update(urllib.parse.parse_qsl(body))
+                if wiki.title not in query.get('pages', '').split('\n'):
+                    content = export_xml(wiki.title, wiki.page_id, [])
+                else:
+                    content = wiki.export(
+                        offset=query.get('offset'),
+                        limit=int(query.get('limit', 5)),
+                        current=bool(query.get('curonly')))
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/xml; charset=utf-8')
+                if wiki.compress and 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+                    content = gzip.compress(content, compresslevel=1)
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# benchmarks
+
+def run_isolated(name, wiki, verbose):
+    # Each benchmark gets a fresh process so its peak RSS is its own.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(run_benchmark, name, wiki.base, wiki.export(), verbose).result()
+
+def run_benchmark(name, base, export, verbose):
+    proof.WIKI_BASE = base
+    workdir = tempfile.mkdtemp(prefix='wikimit-bench-')
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with output:
+            seconds, revisions, size = BENCHMARKS[name](export, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'name': name,
+        'revisions': revisions,
+        'mb': round(size / 1e6, 3),
+        'seconds': round(seconds, 4),
+        'revisions_per_sec': round(revisions / seconds, 1) if seconds else None,
+        'mb_per_sec': round(size / 1e6 / seconds, 2) if seconds else None,
+        # ru_maxrss is in KB on Linux
+        'peak_rss_mb': round(usage.ru_maxrss / 1024, 1),
+        'peak_child_rss_mb': round(children.ru_maxrss / 1024, 1),
+    }
+
+def bench_parse_history(export, workdir):
+    start = time.perf_counter()
+    commits = proof.parse_history(export)
+    return time.perf_counter() - start, len(commits), len(export)
+
+def bench_revision_to_commit(export, workdir):
+    revisions = [revision for page, revision in proof.iter_export([export])]
+    start = time.perf_counter()
+    for revision in revisions:
+        proof.revision_to_commit(revision)
+    return time.perf_counter() - start, len(revisions), len(export)
+
+def bench_add_commits(backend):
+    def bench(export, workdir, batch=100):
+        info = proof.parse_current(export)
+        commits = proof.parse_history(export)
+        proof.first_setup(workdir, info)
+        start = time.perf_counter()
+        for offset in range(0, len(commits), batch):
+            proof.add_commits(workdir, info, commits[offset:offset + batch], backend=backend)
+        size = sum(len(commit.content) for commit in commits)
+        return time.perf_counter() - start, len(commits), size
+    return bench
+
+def bench_process_all(export, workdir):
+    path = os.path.join(workdir, proof.title_to_dirname(BENCH_TITLE))
+    start = time.perf_counter()
+    proof.process_all(BENCH_TITLE, path, proof.SyncOptions())
+    seconds = time.perf_counter() - start
+    info = proof.info_from_json(proof.get_info(path))
+    commits = proof.parse_history(export)
+    if info.synced_revision_id != commits[-1].id:
+        raise RuntimeError('process_all stopped at revision {}'.format(info.synced_revision_id))
+    return seconds, len(commits), len(export)
+
+BENCHMARKS = {
+    'parse_history': bench_parse_history,
+    'revision_to_commit': bench_revision_to_commit,
+    'add_commits[fast-import]': bench_add_commits('fast-import'),
+    'add_commits[subprocess]': bench_add_commits('subprocess'),
+    'process_all': bench_process_all,
+}
+
+# main
+
+if __name__ == "__main__":
+    main()
@@ -2,18 +2,39 @@
 
 import os
 import os.path
-import xml.dom.minidom
-from collections import OrderedDict
+import xml.etree.ElementTree
+from collections import OrderedDict, deque
 from dataclasses import dataclass
 import subprocess
 import json
 import dataclasses
 import datetime
+import calendar
+import argparse
+import concurrent.futures
 import io
+import itertools
+import functools
 import time
 import sys
+import queue
+import threading
+import urllib.parse
+import email.utils
+import random
+import gzip
+import hashlib
+import bz2
+import shutil
+import contextlib
+import heapq
+import bisect
+import asyncio
+import sqlite3
+import tempfile
 
 import requests
+import requests.adapters
 
 # constants
 
@@ -21,14 +42,87 @@ WIKI_BASE = "https://en.wikipedia.org"
 
 # classes
 
-@dataclass
 class Commit:
-    message: str
-    author: str
-    description: str
-    content: str
-    date: str
-    info: dict
+    # One revision, kept small since whole batches are held in memory.
+    # Metadata is stored as parsed, the article text as UTF-8 bytes ready
+    # for git (or a SpooledText when it's over SPOOL_THRESHOLD), and the
+    # strings git needs are only built when committing.
+    __slots__ = (
+        'id',
+        'timestamp',
+        'contributor_username',
+        'contributor_id',
+        'contributor_ip',
+        'minor',
+        'model',
+        'format',
+        'sha1',
+        'comment',
+        'content',
+        'stats',
+    )
+
+    def __init__(self, id, timestamp, contributor_username, contributor_id, contributor_ip,
+                 minor, model, format, sha1, comment, content):
+        self.id = id
+        self.timestamp = timestamp
+        self.contributor_username = contributor_username
+        self.contributor_id = contributor_id
+        self.contributor_ip = contributor_ip
+        self.minor = minor
+        self.model = model
+        self.format = format
+        self.sha1 = sha1
+        self.comment = comment
+        self.content = content
+        # filled in by EditTracker as the revision is committed
+        self.stats = None
+
+    def __eq__(self, other):
+        if not isinstance(other, Commit):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return 'Commit(id={!r}, timestamp={!r})'.format(self.id, self.timestamp)
+
+    @property
+    def date(self):
+        return self.timestamp
+
+    @property
+    def message(self):
+        return self.comment if self.comment else '.'
+
+    @property
+    def author(self):
+        if self.contributor_username:
+            return '{} <{}>'.format(self.contributor_username, self.contributor_id)
+        if self.contributor_ip:
+            return '{} <IP>'.format(self.contributor_ip)
+        # hidden by revision deletion: <contributor deleted="deleted" />
+        return '(deleted) <deleted>'
+
+    @property
+    def info(self):
+        return OrderedDict([
+            ('id', self.id),
+            ('timestamp', self.timestamp),
+            ('contributor_username', self.contributor_username),
+            ('contributor_id', self.contributor_id),
+            ('contributor_ip', self.contributor_ip),
+            ('minor', 'True' if self.minor else 'False'),
+            ('model', self.model),
+            ('format', self.format),
+            ('sha1', self.sha1),
+        ])
+
+    @property
+    def description(self):
+        fields = list(self.info.items())
+        if self.stats:
+            fields.extend(self.stats.items())
+        return '\n'.join(['{}: {}'.format(k, v) for k, v in fields if v != ''])
 
 @dataclass
 class PageInfo:
@@ -42,87 +136,1735 @@ class PageInfo:
     synced_revision_timestamp: str
     last_sync: str
 
+@dataclass
+class SyncOptions:
+    backend: str = 'fast-import'
+    stream: bool = False
+    prefetch: bool = False
+    limit: int = 100
+    adaptive: bool = True
+    target_bytes: int = 8 * 1024 * 1024
+    target_seconds: float = 15.0
+    min_limit: int = 1
+    # Special:Export caps history exports at $wgExportMaxHistory (1000 on Wikipedia)
+    max_limit: int = 1000
+    single_pack: bool = False
+    repack: bool = False
+    # batches between repacks during an import, 0 repacks only at the end
+    repack_every: int = 0
+    # consecutive wikitext revisions are near-identical, so a wide window
+    # and long chains pay off
+    repack_window: int = 250
+    repack_depth: int = 50
+
 # main
 
 def main():
-    if len(sys.argv) < 3:
-        sys.exit('Usage: python proof.py title outdir')
+    parser = argparse.ArgumentParser(prog='proof.py')
+    parser.add_argument('title', nargs='?')
+    parser.add_argument('outdir')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--titles', metavar='FILE',
+        help='mirror every title listed in FILE (one per line) into subdirectories of outdir')
+    source.add_argument('--category', metavar='NAME',
+        help='mirror every article in a category into subdirectories of outdir')
+    parser.add_argument('--workers', type=int, default=4,
+        help='pages synced in parallel when mirroring several titles')
+    parser.add_argument('--fetchers', type=int, default=0,
+        help='keep up to this many exports downloading at once across pages from one event loop, '
+            'feeding --workers committers')
+    parser.add_argument('--rate', type=float, default=None,
+        help='max requests per second to {}, shared by all workers'.format(WIKI_BASE))
+    parser.add_argument('--backend', choices=BACKENDS, default='fast-import',
+        help='how revisions are committed (subprocess is the slow reference path)')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--stream', action='store_true',
+        help='commit revisions while the export is still downloading')
+    mode.add_argument('--prefetch', action='store_true',
+        help='download the next batch while the current one is committed')
+    parser.add_argument('--limit', type=int, default=100,
+        help='revisions requested in the first batch')
+    parser.add_argument('--single-pack', action='store_true',
+        help='import each page through one git fast-import process, writing a single pack and '
+            'checking out only at the end')
+    parser.add_argument('--repack', action='store_true',
+        help='repack each repository once its sync is done and report its storage')
+    parser.add_argument('--repack-every', type=int, default=0, metavar='BATCHES',
+        help='also repack after this many batches during long imports (implies --repack)')
+    parser.add_argument('--repack-window', type=int, default=250,
+        help='objects considered as delta bases when repacking')
+    parser.add_argument('--repack-depth', type=int, default=50,
+        help='longest delta chain allowed when repacking')
+    parser.add_argument('--fixed-limit', action='store_true',
+        help='always request --limit revisions instead of adapting the batch size')
+    parser.add_argument('--target-mb', type=float, default=8.0,
+        help='response size adaptive batches aim for')
+    parser.add_argument('--target-seconds', type=float, default=15.0,
+        help='response time adaptive batches aim for')
+    parser.add_argument('--cache', metavar='DIR',
+        help='keep compressed copies of downloaded exports in DIR and reuse them')
+    parser.add_argument('--replay', action='store_true',
+        help='build the mirror only from batches in --cache, without network access')
+    parser.add_argument('--dump', metavar='FILE', action='append',
+        help='read revisions from a local pages-meta-history dump shard (.xml, .bz2, .gz or .7z) '
+            'instead of Special:Export, may be repeated; --titles/--category select pages, default is all')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+        help='dump shards ingested in parallel')
+    parser.add_argument('--range-mb', type=float, default=1024.0,
+        help='split uncompressed dump shards into page ranges of about this size')
+    parser.add_argument('--monorepo', action='store_true',
+        help='write all pages into the single repository at outdir, merging their histories by timestamp')
+    parser.add_argument('--daemon', action='store_true',
+        help='keep every mirror already under outdir up to date, checking for new edits every --interval')
+    parser.add_argument('--interval', type=float, default=24 * 60 * 60,
+        help='seconds between freshness checks in --daemon mode')
+    parser.add_argument('--once', action='store_true',
+        help='run a single --daemon pass and exit')
+    parser.add_argument('--spool-mb', type=float, metavar='MB',
+        help='spool revision text over MB megabytes to temporary files instead of holding it in memory')
+    parser.add_argument('--index', metavar='FILE',
+        help='keep one SQLite revision index for every page in FILE instead of one per repository')
+    parser.add_argument('--metrics', metavar='FILE',
+        help='append timing spans to FILE as JSON lines, or write Prometheus text if FILE ends in .prom')
+    args = parser.parse_args()
+    if args.daemon:
+        if args.title or args.titles or args.category or args.dump or args.monorepo:
+            parser.error('--daemon syncs the mirrors already in outdir and takes no page selection')
+    elif args.dump:
+        if args.title:
+            parser.error('--dump mirrors every page into outdir, select pages with --titles/--category')
+    elif bool(args.title) == bool(args.titles or args.category):
+        parser.error('pass either a title or one of --titles/--category')
+    if args.monorepo and args.dump:
+        parser.error('--monorepo merges live histories and cannot be combined with --dump')
+    if args.single_pack and args.backend != 'fast-import':
+        parser.error('--single-pack requires the fast-import backend')
+    if args.replay and not args.cache:
+        parser.error('--replay requires --cache')
+    if args.replay and args.category:
+        parser.error('--replay cannot list a category offline, use --titles')
     git_check_min_version()
-    title = sys.argv[1]
-    path = sys.argv[2]
-    process_all(title, path)
-
-def process_all(title, path):
-    done = False
-    while not done:
-        done = process(title, path, limit=100)
+    if args.rate:
+        set_rate_limit(args.rate)
+    set_cache(args.cache, replay=args.replay)
+    set_metrics(args.metrics)
+    set_revision_index(args.index)
+    if args.spool_mb is not None:
+        set_spool_threshold(int(args.spool_mb * 1024 * 1024))
+    options = SyncOptions(
+        backend=args.backend,
+        stream=args.stream,
+        prefetch=args.prefetch,
+        limit=args.limit,
+        adaptive=not args.fixed_limit,
+        target_bytes=int(args.target_mb * 1024 * 1024),
+        target_seconds=args.target_seconds,
+        single_pack=args.single_pack,
+        repack=args.repack or args.repack_every > 0,
+        repack_every=args.repack_every,
+        repack_window=args.repack_window,
+        repack_depth=args.repack_depth)
+    if args.daemon:
+        scheduler = SyncScheduler(args.outdir, options=options, workers=args.workers, interval=args.interval)
+        if args.once:
+            scheduler.run_once()
+        else:
+            scheduler.run_forever()
+        return
+    if args.monorepo:
+        titles = [args.title] if args.title else read_titles(args.titles) if args.titles else download_category_members(args.category)
+        sync_monorepo(titles, args.outdir, options)
+        return
+    if args.title:
+        process_all(args.title, args.outdir, options)
+        return
+    titles = read_titles(args.titles) if args.titles else download_category_members(args.category) if args.category else None
+    if args.dump:
+        failed = ingest_dumps(args.dump, args.outdir, titles=titles, backend=args.backend,
+            processes=args.processes, range_bytes=int(args.range_mb * 1024 * 1024))
+        if failed:
+            sys.exit(1)
+        return
+    if args.fetchers:
+        failed = process_many_async(titles, args.outdir, fetchers=args.fetchers, workers=args.workers, options=options)
+    else:
+        failed = process_many(titles, args.outdir, workers=args.workers, options=options)
+    if failed:
+        sys.exit(1)
+
+def process_all(title, path, options=None):
+    sync_page(title, path, options)
     print('Done!')
-    print_clocks()
-
-def process(title, path, limit):
-    chdir(path)
-    current_info = get_info()
-    current = download_history(title, current=True)
-    print('Querying wikipedia...')
-
-    start_clock('wiki')
-    history = download_history(title, offset=current_info['synced_revision_timestamp'] if current_info else None, limit=limit)
-    stop_clock('wiki')
-
-    info = parse_current(current)
-    if not current_info:
-        first_setup(info)
-    commits = parse_history(history)
+    print_metrics()
+
+def process_many(titles, outdir, workers=4, options=None):
+    # Mirrors each title into its own repository under outdir, running up to
+    # `workers` syncs at once. Returns the titles that failed.
+    failed = []
+    current = fetch_page_infos(titles)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(sync_page, title, os.path.join(outdir, title_to_dirname(title)), options, current.get(title)): title
+            for title in titles
+        }
+        for future in concurrent.futures.as_completed(futures):
+            title = futures[future]
+            try:
+                future.result()
+                print('Synced {}'.format(title))
+            except Exception as error:
+                failed.append(title)
+                print('Failed to sync {}: {!r}'.format(title, error))
+    print('Done! Synced {} of {} pages.'.format(len(futures) - len(failed), len(futures)))
+    print_metrics()
+    return failed
+
+def process_many_async(titles, outdir, fetchers=8, workers=4, options=None):
+    # Like process_many, but downloads come from one event loop that keeps
+    # up to `fetchers` exports in flight across all titles, while `workers`
+    # threads commit the parsed batches. Returns the titles that failed.
+    pipeline = AsyncPipeline(outdir, options or SyncOptions(), fetchers, workers)
+    failed = asyncio.run(pipeline.run(titles))
+    print('Done! Synced {} of {} pages.'.format(len(titles) - len(failed), len(titles)))
+    print_metrics()
+    return failed
+
+class AsyncPipeline:
+    # Each title runs a fetch loop and a commit loop joined by a queue of
+    # parsed batches, so a title's next batch downloads while the previous
+    # one is committed, and batches are always committed in order. Blocking
+    # work runs on two thread pools: requests (still paced by the shared
+    # rate limiter) on the fetch pool, git on the commit pool. A semaphore
+    # caps parsed batches held in memory across all titles.
+
+    def __init__(self, outdir, options, fetchers, workers):
+        self.outdir = outdir
+        self.options = options
+        self.fetchers = fetchers
+        self.workers = workers
+
+    async def run(self, titles):
+        self.pending = asyncio.Semaphore(self.fetchers * 2)
+        self.active = asyncio.Semaphore(self.fetchers + self.workers)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.fetchers) as self.fetch_pool, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as self.commit_pool:
+            current = await self.fetch(fetch_page_infos, titles, spans=())
+            results = await asyncio.gather(*[self.sync_title(title, current.get(title)) for title in titles])
+        return [title for title, synced in zip(titles, results) if not synced]
+
+    # Spans are per thread, so they are never opened on the event loop where
+    # titles interleave. Work on the pools is nested under spans instead,
+    # by default 'page' as in sync_page.
+
+    async def fetch(self, function, *args, spans=('page',)):
+        return await asyncio.get_running_loop().run_in_executor(self.fetch_pool, in_spans, list(spans), function, *args)
+
+    async def commit(self, function, *args, spans=('page',)):
+        return await asyncio.get_running_loop().run_in_executor(self.commit_pool, in_spans, list(spans), function, *args)
+
+    async def sync_title(self, title, current):
+        async with self.active:
+            try:
+                path = os.path.join(self.outdir, title_to_dirname(title))
+                info = await self.commit(load_info, title, path, current)
+                batches = asyncio.Queue()
+                committer = asyncio.ensure_future(self.commit_batches(title, path, info, batches))
+                try:
+                    await self.fetch_batches(title, info, batches, committer, fresh=current is not None)
+                finally:
+                    batches.put_nowait(None)
+                    await committer
+            except Exception as error:
+                print('Failed to sync {}: {!r}'.format(title, error))
+                return False
+            print('Synced {}'.format(title))
+            return True
+
+    async def fetch_batches(self, title, info, batches, committer, fresh=False):
+        sizer = BatchSizer(self.options)
+        last_id = info.synced_revision_id
+        offset = info.synced_revision_timestamp or None
+        while not committer.done():
+            if last_id == info.highest_known_revision_id and (fresh or not await self.fetch(refresh_current, title, info)):
+                break
+            fresh = False
+            await self.pending.acquire()
+            try:
+                commits = await self.fetch(fetch_commits, title, info, offset, sizer)
+            except BaseException:
+                self.pending.release()
+                raise
+            if not commits or committer.done():
+                self.pending.release()
+                break
+            batches.put_nowait(commits)
+            last_id = commits[-1].id
+            offset = commits[-1].date
+        sizer.print_summary(title)
+
+    async def commit_batches(self, title, path, info, batches):
+        importer = None
+        repacker = Repacker(title, path, self.options)
+        try:
+            while True:
+                commits = await batches.get()
+                if commits is None:
+                    break
+                try:
+                    if importer is None and self.options.single_pack:
+                        importer = await self.commit(FastImportSession, path)
+                    await self.commit(self.commit_batch, path, info, commits, importer)
+                except BaseException:
+                    # batches left behind will never be committed
+                    while not batches.empty():
+                        if batches.get_nowait() is not None:
+                            self.pending.release()
+                    raise
+                finally:
+                    self.pending.release()
+                print('Added {} commits to {}'.format(len(commits), os.path.basename(path)))
+                await self.commit(repacker.batch_done)
+            if importer:
+                await self.commit(importer.close)
+            await self.commit(repacker.finish)
+        except BaseException:
+            if importer:
+                await self.commit(importer.abort)
+            raise
+
+    def commit_batch(self, path, info, commits, importer):
+        with span('commit', revisions=len(commits)):
+            add_commits(path, info, commits, backend=self.options.backend, importer=importer)
+
+def sync_page(title, path, options=None, current=None):
+    # current is an already fetched PageInfo for the newest revision, which
+    # saves downloading it up front.
+    options = options or SyncOptions()
+    with span('page', title=title):
+        info = load_info(title, path, current)
+        sizer = BatchSizer(options)
+        importer = FastImportSession(path) if options.single_pack else None
+        repacker = Repacker(title, path, options)
+        with importer or contextlib.nullcontext():
+            # a current passed in was just looked up, so the first check
+            # doesn't download it again
+            fresh = current is not None
+            if options.prefetch:
+                process_prefetch(title, path, info, sizer, options.backend, importer, repacker.batch_done, fresh)
+            else:
+                done = False
+                while not done:
+                    with span('batch', title=title):
+                        done = process(title, path, info, sizer, backend=options.backend, stream=options.stream,
+                            importer=importer, fresh=fresh)
+                    fresh = False
+                    if not done:
+                        repacker.batch_done()
+        repacker.finish()
+    sizer.print_summary(title)
+
+def load_info(title, path, current=None):
+    # Reuses the page metadata in info.json when there is one, so the current
+    # revision is only downloaded for new mirrors or once the sync catches up.
+    make_dir(path)
+    info = resume_info(path)
+    if info:
+        if current:
+            info.highest_known_revision_id = current.highest_known_revision_id
+            info.highest_known_revision_timestamp = current.highest_known_revision_timestamp
+        return info
+    info = current or parse_current(download_history(title, current=True))
+    first_setup(path, info)
+    return info
+
+def refresh_current(title, info):
+    # Returns whether the page was edited since info was last refreshed.
+    current = parse_current(download_history(title, current=True))
+    changed = current.highest_known_revision_id != info.highest_known_revision_id
+    info.highest_known_revision_id = current.highest_known_revision_id
+    info.highest_known_revision_timestamp = current.highest_known_revision_timestamp
+    return changed
+
+def is_synced(title, info, fresh=False):
+    # fresh means info's newest revision was just looked up, so it is
+    # trusted instead of downloading the current revision again.
+    return info.synced_revision_id == info.highest_known_revision_id and (fresh or not refresh_current(title, info))
+
+def process(title, path, info, sizer, backend='fast-import', stream=False, importer=None, fresh=False):
+    if is_synced(title, info, fresh):
+        print('No more work to do!')
+        return True
+    offset = info.synced_revision_timestamp or None
+    if stream:
+        return process_stream(title, path, info, offset, sizer, backend, importer)
+
+    commits = fetch_commits(title, info, offset, sizer)
     if not commits:
         print('No more work to do!')
         return True
     print('Adding {} commits...'.format(len(commits)))
 
-    start_clock('git')
-    add_commits(path, info, commits)
-    stop_clock('git')
+    with span('commit', revisions=len(commits)):
+        add_commits(path, info, commits, backend=backend, importer=importer)
+
+    return False
+
+def process_stream(title, path, info, offset, sizer, backend, importer=None):
+    # Download, parse and commit overlap: chunks are read on a background
+    # thread, revisions are parsed as they complete, and each commit goes
+    # straight to the git writer.
+    print('Streaming from wikipedia...')
+
+    limit = sizer.limit
+    size = [0]
+    seconds = [0.0]
+    def counted(chunks):
+        # Only waiting on the response counts as download time; handing a
+        # chunk on can block behind the commits.
+        chunks = iter(chunks)
+        while True:
+            started = time.perf_counter()
+            chunk = next(chunks, None)
+            seconds[0] += time.perf_counter() - started
+            if chunk is None:
+                return
+            size[0] += len(chunk)
+            yield chunk
+
+    with span('stream', limit=limit):
+        started = time.perf_counter()
+        response = download_history(title, offset=offset, limit=limit, stream=True)
+        seconds[0] += time.perf_counter() - started
+        chunks = iter_background(counted(response))
+        commits = LastSeen(iter_history(chunks))
+        count = add_commits(path, info, commits, backend=backend, importer=importer)
+    sizer.update(info, limit, count, commits.last, size[0], seconds[0])
+
+    if not count:
+        print('No more work to do!')
+        return True
+    print('Added {} commits'.format(count))
 
-    return info.synced_revision_id == info.highest_known_revision_id
+    return False
 
-# perf
+def process_prefetch(title, path, info, sizer, backend, importer=None, batch_done=None, fresh=False):
+    # Pipelines batches: while batch N is committed, batch N+1 is downloaded
+    # and parsed on a background thread, starting from the last timestamp
+    # of batch N rather than waiting for info.json to catch up.
+    if is_synced(title, info, fresh):
+        print('No more work to do!')
+        return
+    offset = info.synced_revision_timestamp or None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        parents = open_spans()
+        pending = executor.submit(in_spans, parents, fetch_commits, title, info, offset, sizer)
+        while pending:
+            commits = pending.result()
+            if not commits:
+                print('No more work to do!')
+                break
+            last = commits[-1]
+            if last.id != info.highest_known_revision_id or refresh_current(title, info):
+                pending = executor.submit(in_spans, parents, fetch_commits, title, info, last.date, sizer)
+            else:
+                pending = None
+            print('Adding {} commits...'.format(len(commits)))
+
+            with span('commit', revisions=len(commits)):
+                add_commits(path, info, commits, backend=backend, importer=importer)
+            if batch_done:
+                batch_done()
+
+def fetch_commits(title, info, offset, sizer):
+    limit = sizer.limit
+    print('Querying wikipedia for {} revisions...'.format(limit))
+    with span('download', limit=limit) as timer:
+        history = download_history(title, offset=offset, limit=limit)
+    with span('parse'):
+        commits = parse_history(history)
+    sizer.update(info, limit, len(commits), commits[-1] if commits else None, len(history), timer.elapsed)
+    return commits
+
+class LastSeen:
+    # Passes an iterable through while remembering its last item.
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.last = None
+
+    def __iter__(self):
+        for item in self.iterable:
+            self.last = item
+            yield item
+
+# batches
+
+class BatchSizer:
+    # Chooses the Special:Export limit for each batch from what earlier
+    # batches cost (bytes and seconds per revision), aiming at the target
+    # response size and time. A batch that comes back short of the request
+    # without reaching the newest revision was truncated by the server, and
+    # caps later requests at that size.
+
+    def __init__(self, options):
+        self.limit = options.limit
+        self.adaptive = options.adaptive
+        self.target_bytes = options.target_bytes
+        self.target_seconds = options.target_seconds
+        self.min_limit = options.min_limit
+        self.max_limit = options.max_limit
+        self.bytes_per_revision = None
+        self.seconds_per_revision = None
+        self.history = []
+
+    def update(self, info, requested, count, last, size, elapsed):
+        self.history.append(requested)
+        if not self.adaptive or not count:
+            return
+        truncated = count < requested and last is not None and last.id != info.highest_known_revision_id
+        if truncated and count < self.max_limit:
+            print('Server truncated batch to {} revisions'.format(count))
+            self.max_limit = max(self.min_limit, count)
+        self.bytes_per_revision = smooth(self.bytes_per_revision, size / count)
+        self.seconds_per_revision = smooth(self.seconds_per_revision, elapsed / count)
+        ideal = min(
+            self.target_bytes / max(self.bytes_per_revision, 1.0),
+            self.target_seconds / max(self.seconds_per_revision, 1e-6))
+        # Grow gradually so one cheap batch can't cause a runaway request
+        limit = min(int(ideal), requested * 4)
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+        print('Next batch limit: {} ({:.1f} KB and {:.3f} s per revision)'.format(
+            self.limit, self.bytes_per_revision / 1024, self.seconds_per_revision))
+
+    def print_summary(self, title):
+        if self.history:
+            print('Batch limits for {}: min {}, max {}, last {}'.format(
+                title, min(self.history), max(self.history), self.history[-1]))
+
+def smooth(average, value, weight=0.5):
+    return value if average is None else average * (1 - weight) + value * weight
+
+# repack
+
+class Repacker:
+    # Repacks a page's repository every options.repack_every batches and
+    # once more when the sync finishes. A --single-pack import holds its
+    # pack open until it closes, so interval repacks wait for the final one.
+
+    def __init__(self, title, path, options):
+        self.title = title
+        self.path = path
+        self.options = options
+        self.every = options.repack_every if options.repack and not options.single_pack else 0
+        self.batches = 0
+        self.dirty = False
+
+    def batch_done(self):
+        self.batches += 1
+        self.dirty = True
+        if self.every and self.batches % self.every == 0:
+            repack(self.path, self.options, self.title)
+            self.dirty = False
+
+    def finish(self):
+        if self.options.repack and self.dirty:
+            repack(self.path, self.options, self.title)
+
+def repack(path, options, title=None):
+    # Rewrites every object into one pack, recomputing deltas, and reports
+    # what the repository costs on disk.
+    with span('repack'):
+        git_repack(path, options.repack_window, options.repack_depth)
+        stats = git_count_objects(path)
+        raw = git_object_bytes(path)
+    packed = (stats.get('size-pack', 0) + stats.get('size', 0)) * 1024
+    objects = stats.get('in-pack', 0) + stats.get('count', 0)
+    count_metric('repacks')
+    count_metric('packed_bytes', packed)
+    count_metric('object_bytes', raw)
+    print('Repacked {}: {} objects, {:.2f} MB on disk for {:.2f} MB of objects ({:.1f}x)'.format(
+        title or path, objects, packed / 1e6, raw / 1e6, raw / packed if packed else 0.0))
+    return objects, packed, raw
+
+# dumps
+
+def ingest_dumps(names, outdir, titles=None, backend='fast-import', processes=None, range_bytes=None):
+    # Coordinates ingestion of dump shards (or page ranges of uncompressed
+    # shards) over a process pool. Finished tasks are recorded in
+    # outdir/ingest.json and pages resume from their own info.json, so a
+    # killed run picks up without redoing finished work.
+    make_dir(outdir)
+    progress = IngestProgress(outdir)
+    tasks = [task for name in names for task in dump_tasks(name, range_bytes) if not progress.is_done(task)]
+    print('Ingesting {} dump tasks ({} already done)...'.format(len(tasks), len(progress.completed)))
+    pages, commits = 0, 0
+    failed = []
+    # workers start with empty metrics and send theirs back with each task
+    settings = (METRICS.name, REVISION_INDEX and REVISION_INDEX.name, SPOOL_THRESHOLD)
+    with span('dump'), concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes, initializer=init_dump_worker, initargs=settings) as executor:
+        futures = {executor.submit(ingest_dump, task, outdir, titles, backend): task for task in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            task = futures[future]
+            try:
+                task_pages, task_commits, task_metrics = future.result()
+            except Exception as error:
+                failed.append(task)
+                print('Failed to ingest {}: {!r}'.format(describe_task(task), error))
+                continue
+            pages += task_pages
+            commits += task_commits
+            METRICS.merge(task_metrics)
+            progress.mark_done(task)
+            print('Finished {} ({} pages, {} commits)'.format(describe_task(task), task_pages, task_commits))
+    print('Done! Ingested {} commits into {} pages.'.format(commits, pages))
+    print_metrics()
+    return failed
+
+def init_dump_worker(metrics, index, spool_threshold):
+    # Hands workers the settings main() made, whether or not the pool forks.
+    set_metrics(metrics)
+    set_revision_index(index)
+    set_spool_threshold(spool_threshold)
+
+def ingest_dump(task, outdir, titles=None, backend='fast-import'):
+    # Mirrors the pages of one dump task in a single sequential read. Each
+    # page's revisions are committed into outdir/<title> as they are parsed,
+    # so memory is bounded by one revision whatever the dump size.
+    name, start, end = task
+    wanted = set(titles) if titles is not None else None
+    pages, commits = 0, 0
+    chunks = iter_dump_chunks(name) if start is None else iter_dump_range(name, start, end)
+    revisions = iter_export(iter_background(chunks))
+    for page, group in itertools.groupby(revisions, key=lambda item: item[0]):
+        title = getChildText(page, 'title')
+        if wanted is not None and title not in wanted:
+            continue
+        with span('page', title=title):
+            count = ingest_page(page, (revision for _, revision in group),
+                os.path.join(outdir, title_to_dirname(title)), backend)
+        pages += 1
+        commits += count
+        print('Added {} commits to {}'.format(count, title))
+    return pages, commits, METRICS.drain()
+
+def ingest_page(page, revisions, path, backend):
+    # Resumes where the last run stopped when the page was partly ingested before.
+    make_dir(path)
+    info = resume_info(path)
+    commits = (revision_to_commit(revision) for revision in revisions)
+    if info:
+        commits = (commit for commit in commits if commit.date > info.synced_revision_timestamp)
+    commits = iter(commits)
+    first = next(commits, None)
+    if first is None:
+        return 0
+    if not info:
+        info = page_to_info(page, first)
+        first_setup(path, info)
+    return add_commits(path, info, track_highest_known(info, itertools.chain([first], commits)), backend=backend)
+
+def page_to_info(page, commit):
+    return new_page_info(getChildText(page, 'id'), getChildText(page, 'title'), commit.id, commit.date)
+
+def track_highest_known(info, commits):
+    # A dump's newest revision of a page is only known once the page ends,
+    # so the highest known revision advances with each commit.
+    for commit in commits:
+        info.highest_known_revision_id = commit.id
+        info.highest_known_revision_timestamp = commit.date
+        yield commit
+
+DUMP_CHUNK_SIZE = 1024 * 1024
+
+def dump_tasks(name, range_bytes=None):
+    # Compressed shards are read whole; uncompressed ones can be split into
+    # byte ranges, each owning the pages that start inside it.
+    size = os.path.getsize(name)
+    if not name.endswith('.xml') or not range_bytes or size <= range_bytes:
+        return [(name, None, None)]
+    return [(name, start, min(size, start + range_bytes)) for start in range(0, size, range_bytes)]
+
+def describe_task(task):
+    name, start, end = task
+    return name if start is None else '{} [{}:{}]'.format(name, start, end)
+
+class IngestProgress:
+
+    def __init__(self, outdir):
+        self.name = os.path.join(outdir, 'ingest.json')
+        self.completed = []
+        if os.path.exists(self.name):
+            with io.open(self.name, 'r', encoding='utf8') as file:
+                self.completed = json.loads(file.read())['completed']
+
+    def is_done(self, task):
+        return describe_task(task) in self.completed
+
+    def mark_done(self, task):
+        self.completed.append(describe_task(task))
+        with io.open(self.name + '.tmp', 'w', encoding='utf8') as file:
+            file.write(json.dumps({'completed': self.completed}, indent=4))
+        os.replace(self.name + '.tmp', self.name)
+
+def iter_dump_range(name, start, end):
+    # Yields a standalone document holding the <page> elements that start in
+    # [start, end). Wikitext is escaped, so a raw '<page>' is always markup.
+    marker = b'<page>'
+    keep = len(marker) - 1
+    yield b'<mediawiki>'
+    with open(name, 'rb') as file:
+        file.seek(start)
+        offset = start
+        buffer = b''
+        started = False
+        while True:
+            chunk = file.read(DUMP_CHUNK_SIZE)
+            buffer += chunk
+            if not started:
+                index = buffer.find(marker)
+                if index < 0:
+                    if not chunk:
+                        break
+                    drop = max(0, len(buffer) - keep)
+                    offset += drop
+                    buffer = buffer[drop:]
+                    continue
+                offset += index
+                buffer = buffer[index:]
+                if offset >= end:
+                    break
+                started = True
+            index = buffer.find(marker, max(1, end - offset))
+            if index >= 0:
+                yield buffer[:index]
+                break
+            if not chunk:
+                # The last range already ends with the dump's </mediawiki>
+                yield buffer
+                return
+            drop = max(0, len(buffer) - keep)
+            yield buffer[:drop]
+            offset += drop
+            buffer = buffer[drop:]
+    yield b'</mediawiki>'
+
+def iter_dump_chunks(name):
+    with open_dump(name) as file:
+        while True:
+            chunk = file.read(DUMP_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+def open_dump(name):
+    # Parallel bzip2 and 7-Zip are external tools, used when installed.
+    if name.endswith('.bz2'):
+        decompressor = shutil.which('lbzip2') or shutil.which('pbzip2')
+        if decompressor:
+            return open_pipe([decompressor, '-dc', name])
+        return bz2.open(name, 'rb')
+    if name.endswith('.gz'):
+        return gzip.open(name, 'rb')
+    if name.endswith('.7z'):
+        if not shutil.which('7z'):
+            raise RuntimeError('Reading .7z dumps requires the 7z command')
+        return open_pipe(['7z', 'e', '-so', name])
+    return open(name, 'rb')
+
+@contextlib.contextmanager
+def open_pipe(command):
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        yield process.stdout
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+
+# monorepo
+
+MONOREPO_CHECKPOINT = 10000
+# Pages merged by timestamp at once. Larger lists are mirrored a group at a
+# time, so startup work and per-page state stay bounded.
+MONOREPO_MERGE_PAGES = 1000
+# Recent texts remembered per page; most reverts undo one of the last few edits.
+MONOREPO_BLOB_WINDOW = 32
+
+@dataclass
+class MonorepoPage:
+    title: str
+    prefix: str
+    info: PageInfo
+    fresh: bool = False
+    blobs: 'BlobMap' = None
+    edits: 'EditTracker' = None
+
+def sync_monorepo(titles, path, options=None):
+    # Mirrors many pages into one repository. Each page keeps its own
+    # article.xml and info.json under a sharded prefix, and revisions from
+    # each group of MONOREPO_MERGE_PAGES pages are merged by timestamp into
+    # one commit stream written by a single git fast-import process.
+    options = options or SyncOptions()
+    make_dir(path)
+    if not os.path.exists(os.path.join(path, '.git')):
+        monorepo_setup(path)
+    else:
+        # an interrupted run leaves HEAD at its last checkpoint, ahead of the
+        # work tree that pages are loaded from
+        git_reset_hard(path)
+    articles = git_ls_tree(path, 'HEAD', 'pages')
+    count = 0
+    synced = 0
+    rows = []
+    with span('monorepo', pages=len(titles)), GitFastImport(path) as fast_import:
+        for start in range(0, len(titles), MONOREPO_MERGE_PAGES):
+            pages = load_monorepo_pages(titles[start:start + MONOREPO_MERGE_PAGES], path, articles)
+            synced += len(pages)
+            streams = [iter_monorepo_commits(page, BatchSizer(options)) for page in pages]
+            for page, commit in heapq.merge(*streams, key=lambda item: item[1].date):
+                update_info(page.info, commit)
+                page.edits.measure(commit)
+                fast_import.commit(
+                    author=commit.author,
+                    date=commit.date,
+                    message=git_message(commit) + 'page: {}\n'.format(page.title),
+                    files=[
+                        (page.prefix + '/info.json', info_to_json(page.info).encode('utf8')),
+                    ],
+                    refs=page.blobs.changes(fast_import, page.prefix + '/article.xml', commit))
+                rows.append(index_row(page.title, commit))
+                count += 1
+                count_metric('revisions_committed')
+                count_metric('bytes_committed', len(commit.content))
+                if count % MONOREPO_CHECKPOINT == 0:
+                    fast_import.checkpoint()
+                    for page in pages:
+                        page.edits.flush()
+                    # an interrupted run resumes after the checkpoint, so
+                    # its commits are indexed now
+                    index_commits(path, rows)
+                    rows = []
+                    print('Added {} commits...'.format(count))
+            for page in pages:
+                page.edits.flush()
+    index_commits(path, rows)
+    git_reset_hard(path)
+    if options.repack:
+        repack(path, options)
+    print('Done! Added {} commits across {} of {} pages.'.format(count, synced, len(titles)))
+    print_metrics()
+
+def monorepo_setup(path):
+    git_init(path)
 
-CLOCKS = {}
-ELAPSED = {}
+    readme_name = 'README.md'
+    license_name = 'LICENSE'
+
+    with io.open(os.path.join(path, readme_name), 'w', encoding='utf8') as file:
+        file.write(MONOREPO_README_TEMPLATE)
+    with io.open(os.path.join(path, license_name), 'w', encoding='utf8') as file:
+        file.write(LICENSE_CC_BY_SA)
+
+    git_add(path, readme_name)
+    git_add(path, license_name)
+
+    git_commit_initial(path)
+
+def monorepo_prefix(title):
+    shard = hashlib.sha1(title.encode('utf8')).hexdigest()[:2]
+    return 'pages/{}/{}'.format(shard, title_to_dirname(title))
+
+def load_monorepo_pages(titles, path, articles):
+    # Newest revisions come from one batched lookup, which sets up new pages
+    # and lets up to date ones skip downloading anything. A page's current
+    # article is only read once it has a revision to measure.
+    current = fetch_page_infos(titles)
+    # replay mode makes no lookup, so only a live one says a title is missing
+    looked_up = not (WIKI_CACHE and WIKI_CACHE.replay)
+    pages = []
+    for title in titles:
+        page = None if looked_up and title not in current else load_monorepo_page(title, path, current.get(title))
+        if page is None:
+            print('Skipping {}: page not found'.format(title))
+            continue
+        page.blobs = BlobMap(
+            current=articles.get(page.prefix + '/article.xml', ''),
+            window=MONOREPO_BLOB_WINDOW)
+        page.edits = EditTracker(
+            state_path(path, os.path.join('edits', page.prefix + '.jsonl')),
+            functools.partial(git_show, path, 'HEAD:{}/article.xml'.format(page.prefix)))
+        pages.append(page)
+    return pages
+
+def load_monorepo_page(title, path, current=None):
+    prefix = monorepo_prefix(title)
+    current_info = get_info(os.path.join(path, prefix))
+    if current_info:
+        info = info_from_json(current_info)
+        if current:
+            info.highest_known_revision_id = current.highest_known_revision_id
+            info.highest_known_revision_timestamp = current.highest_known_revision_timestamp
+    elif current:
+        info = current
+    else:
+        try:
+            info = parse_current(download_history(title, current=True))
+        except ValueError:
+            return None
+    return MonorepoPage(title=title, prefix=prefix, info=info, fresh=current is not None)
+
+def iter_monorepo_commits(page, sizer):
+    for commit in iter_page_commits(page.title, page.info, sizer, fresh=page.fresh):
+        yield page, commit
+
+def iter_page_commits(title, info, sizer, fresh=False):
+    # Lazily pages through a title's history. Batches are held gzipped and
+    # parsed as the merge asks for commits, so each waiting page costs its
+    # compressed batch rather than a list of parsed revisions. fresh means
+    # info's newest revision was just looked up, so the first check trusts it.
+    last_id = info.synced_revision_id
+    offset = info.synced_revision_timestamp or None
+    while last_id != info.highest_known_revision_id or (not fresh and refresh_current(title, info)):
+        fresh = False
+        limit = sizer.limit
+        with span('download', title=title, limit=limit) as timer:
+            history = download_history(title, offset=offset, limit=limit)
+        elapsed = timer.elapsed
+        size = len(history)
+        history = gzip.compress(history, compresslevel=1)
+        count = 0
+        last = None
+        for last in iter_history(iter_gzip_chunks(history)):
+            count += 1
+            yield last
+        sizer.update(info, limit, count, last, size, elapsed)
+        if not count:
+            return
+        last_id = last.id
+        offset = last.date
+
+def iter_gzip_chunks(data):
+    with gzip.GzipFile(fileobj=io.BytesIO(data)) as file:
+        while True:
+            chunk = file.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+# scheduler
+
+class WikiApi:
+    # Freshness checks through the MediaWiki Action API. Kept behind a small
+    # class so the scheduler can be driven by a fake.
+
+    BATCH_SIZE = 50
+
+    def page_infos(self, titles):
+        # Returns {title: PageInfo} of the newest revision for titles that
+        # exist, asking about BATCH_SIZE titles per request without article
+        # text. See parameters here:
+        # https://www.mediawiki.org/wiki/API:Revisions
+        url = '{}/w/api.php'.format(WIKI_BASE)
+        infos = OrderedDict()
+        for start in range(0, len(titles), self.BATCH_SIZE):
+            batch = titles[start:start + self.BATCH_SIZE]
+            data = wiki_request('POST', url, data={
+                'action': 'query',
+                'prop': 'revisions',
+                'rvprop': 'ids|timestamp',
+                'titles': '|'.join(batch),
+                'format': 'json',
+                'formatversion': '2',
+            }).json()
+            query = data.get('query', {})
+            aliases = {item['to']: item['from'] for item in query.get('normalized', [])}
+            for page in query.get('pages', []):
+                if page.get('missing') or not page.get('revisions'):
+                    continue
+                revision = page['revisions'][0]
+                info = new_page_info(str(page['pageid']), page['title'], str(revision['revid']), revision['timestamp'])
+                infos[aliases.get(page['title'], page['title'])] = info
+        return infos
+
+def fetch_page_infos(titles, api=None):
+    # Newest revision of many titles in a handful of requests. The Action API
+    # answers without article text; if it can't be used, batched curonly
+    # exports are streamed instead, dropping each article once it is parsed.
+    if WIKI_CACHE and WIKI_CACHE.replay:
+        return {}
+    api = api or WikiApi()
+    try:
+        return api.page_infos(titles)
+    except (requests.RequestException, ValueError, KeyError) as error:
+        print('Action API lookup failed ({!r}), falling back to Special:Export'.format(error))
+        return fetch_current_infos(titles, api.BATCH_SIZE)
+
+def fetch_current_infos(titles, batch_size=50):
+    infos = OrderedDict()
+    for start in range(0, len(titles), batch_size):
+        batch = titles[start:start + batch_size]
+        requested = {normalize_title(title): title for title in batch}
+        found = parse_current_many(download_history(batch, current=True, stream=True))
+        for title, info in found.items():
+            infos[requested.get(title, title)] = info
+    return infos
+
+def normalize_title(title):
+    title = title.replace('_', ' ').strip()
+    return title[:1].upper() + title[1:]
 
-def start_clock(name):
-    CLOCKS[name] = time.perf_counter()
+@dataclass
+class PageState:
+    title: str
+    path: str
+    synced_revision_id: str
+    last_sync: float
+    # EWMA of detected edits per day
+    edit_rate: float = 0.0
+    last_checked: float = 0.0
+
+class SyncScheduler:
+    # Keeps a fleet of mirrors under root current. Each pass checks every
+    # page's newest revision in batched API calls, then syncs only the pages
+    # that changed, stalest and busiest first. Unchanged pages cost one entry
+    # in a batched request and nothing else.
+
+    def __init__(self, root, api=None, options=None, workers=4, interval=24 * 60 * 60):
+        self.root = root
+        self.api = api or WikiApi()
+        self.options = options or SyncOptions()
+        self.workers = workers
+        self.interval = interval
+        self.pages = {}
+
+    def run_forever(self):
+        while True:
+            started = time.monotonic()
+            try:
+                self.run_once()
+            except Exception as error:
+                print('Sync pass failed: {!r}'.format(error))
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def run_once(self):
+        self.discover()
+        due = self.check()
+        print('Checked {} pages, {} have new edits'.format(len(self.pages), len(due)))
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # The executor starts work in submission order, i.e. by priority
+            futures = {executor.submit(sync_page, page.title, page.path, self.options, current): page for page, current in due}
+            for future in concurrent.futures.as_completed(futures):
+                page = futures[future]
+                try:
+                    future.result()
+                except Exception as error:
+                    failed.append(page.title)
+                    print('Failed to sync {}: {!r}'.format(page.title, error))
+                self.reload(page)
+        print_metrics()
+        return failed
+
+    def discover(self):
+        for name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, name)
+            if path not in self.pages and os.path.exists(os.path.join(path, 'info.json')):
+                self.pages[path] = PageState(title='', path=path, synced_revision_id='', last_sync=0.0)
+                self.reload(self.pages[path])
+
+    def reload(self, page):
+        info = get_info(page.path)
+        page.title = info['title']
+        page.synced_revision_id = info['synced_revision_id']
+        page.last_sync = parse_timestamp(info['last_sync']) if info['last_sync'] else 0.0
+
+    def check(self):
+        # Returns [(page, current PageInfo)] for pages with new edits, highest
+        # priority first.
+        now = time.time()
+        pages = list(self.pages.values())
+        current = fetch_page_infos([page.title for page in pages], self.api)
+        queue = []
+        for page in pages:
+            revision = current.get(page.title)
+            changed = revision is not None and revision.highest_known_revision_id != page.synced_revision_id
+            if page.last_checked:
+                days = max(now - page.last_checked, 1.0) / 86400
+                page.edit_rate = smooth(page.edit_rate, (1 if changed else 0) / days, weight=0.3)
+            page.last_checked = now
+            if changed:
+                heapq.heappush(queue, (-self.priority(page, now), page.path, page, revision))
+        return [(page, revision) for _, _, page, revision in (heapq.heappop(queue) for _ in range(len(queue)))]
+
+    def priority(self, page, now):
+        staleness_days = (now - page.last_sync) / 86400
+        return staleness_days * (1 + page.edit_rate)
+
+def parse_timestamp(timestamp):
+    return calendar.timegm(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
 
-def stop_clock(name):
-    elapsed = time.perf_counter() - CLOCKS[name]
-    ELAPSED[name] = ELAPSED.get(name, 0) + elapsed
-    print('{} took {:.2f} seconds'.format(name, elapsed))
-    return elapsed
+# perf
 
-def print_clocks():
-    for name, elapsed in ELAPSED.items():
-        print('{} took a total of {:.2f} seconds'.format(name, elapsed))
+class Metrics:
+    # Spans, counters and latency histograms, safe to use from any thread.
+    # Spans nest per thread and are named by their path, e.g.
+    # 'page/batch/download', and every span's duration lands in the
+    # histogram for that path. When name is given, each finished span is
+    # appended to it as a JSON line, or for names ending in .prom the totals
+    # are written there in Prometheus text format by write().
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+    def __init__(self, name=None):
+        self.name = name
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counters = OrderedDict()
+        self.histograms = OrderedDict()
+        self.events = None
+        if name and not name.endswith('.prom'):
+            self.events = io.open(name, 'a', encoding='utf8')
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextlib.contextmanager
+    def under(self, parents):
+        # Nests this thread's spans under parents, e.g. the spans open on the
+        # thread that handed it the work.
+        stack = self.stack()
+        saved = stack[:]
+        stack[:] = parents
+        try:
+            yield
+        finally:
+            stack[:] = saved
+
+    @contextlib.contextmanager
+    def span(self, name, **fields):
+        stack = self.stack()
+        stack.append(name)
+        path = '/'.join(stack)
+        timer = Timer()
+        try:
+            yield timer
+        except BaseException as error:
+            fields['error'] = type(error).__name__
+            raise
+        finally:
+            timer.stop()
+            stack.pop()
+            self.observe(path, timer.elapsed)
+            if self.events:
+                self.emit(dict(type='span', name=path, start=round(timer.started_at, 6),
+                    seconds=round(timer.elapsed, 6), **fields))
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                # one count per bucket and +Inf, then the total count and sum
+                histogram = self.histograms[name] = [0] * (len(self.BUCKETS) + 3)
+            histogram[bisect.bisect_left(self.BUCKETS, value)] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    def emit(self, event):
+        event['pid'] = os.getpid()
+        event['thread'] = threading.current_thread().name
+        line = json.dumps(event) + '\n'
+        with self.lock:
+            # flushed per line so forked workers never inherit buffered events
+            self.events.write(line)
+            self.events.flush()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {name: list(values) for name, values in self.histograms.items()},
+            }
+
+    def drain(self):
+        # Returns the totals so far and starts over, so a worker process can
+        # report each task once.
+        with self.lock:
+            snapshot = {'counters': self.counters, 'histograms': self.histograms}
+            self.counters = OrderedDict()
+            self.histograms = OrderedDict()
+        return snapshot
+
+    def merge(self, snapshot):
+        # Folds in the totals of another process, e.g. a dump worker.
+        with self.lock:
+            for name, amount in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+            for name, values in snapshot['histograms'].items():
+                histogram = self.histograms.setdefault(name, [0] * len(values))
+                for index, value in enumerate(values):
+                    histogram[index] += value
+
+    def write(self):
+        if not self.name:
+            return
+        snapshot = self.snapshot()
+        if self.events:
+            self.emit(dict(type='totals', time=round(time.time(), 6), **snapshot))
+            return
+        with io.open(self.name + '.tmp', 'w', encoding='utf8') as file:
+            file.write(prometheus_text(snapshot, self.BUCKETS))
+        os.replace(self.name + '.tmp', self.name)
+
+class Timer:
+    __slots__ = ('started', 'started_at', 'elapsed')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.elapsed = None
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.started
+
+def prometheus_text(snapshot, buckets):
+    # See the format here:
+    # https://prometheus.io/docs/instrumenting/exposition_formats/
+    lines = []
+    for name, value in sorted(snapshot['counters'].items()):
+        metric = 'wikimit_{}_total'.format(name)
+        lines.append('# TYPE {} counter'.format(metric))
+        lines.append('{} {}'.format(metric, value))
+    if snapshot['histograms']:
+        lines.append('# TYPE wikimit_span_seconds histogram')
+    for name, values in sorted(snapshot['histograms'].items()):
+        label = 'span="{}"'.format(name.replace('\\', '\\\\').replace('"', '\\"'))
+        cumulative = 0
+        for bound, value in zip(buckets + ('+Inf',), values):
+            cumulative += value
+            lines.append('wikimit_span_seconds_bucket{{{},le="{}"}} {}'.format(label, bound, cumulative))
+        lines.append('wikimit_span_seconds_sum{{{}}} {}'.format(label, values[-1]))
+        lines.append('wikimit_span_seconds_count{{{}}} {}'.format(label, values[-2]))
+    return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
+
+def set_metrics(name):
+    global METRICS
+    METRICS = Metrics(name)
+
+def span(name, **fields):
+    return METRICS.span(name, **fields)
+
+def open_spans():
+    return list(METRICS.stack())
+
+def in_spans(parents, function, *args):
+    # Runs function under parents; work handed to a pool thread would
+    # otherwise start its spans at the top level.
+    with METRICS.under(parents):
+        return function(*args)
+
+def count_metric(name, amount=1):
+    METRICS.count(name, amount)
+
+def print_metrics():
+    for name, values in METRICS.snapshot()['histograms'].items():
+        print('{} took a total of {:.2f} seconds over {} runs'.format(name, values[-1], values[-2]))
+    print_wiki_stats()
+    print_cache_stats()
+    METRICS.write()
 
 # local
 
-def chdir(path):
+def make_dir(path):
     if not os.path.exists(path):
-        os.mkdir(path)
-    os.chdir(path)
+        os.makedirs(path)
 
-def get_info():
-    info_name = 'info.json'
+def title_to_dirname(title):
+    return urllib.parse.quote(title.replace(' ', '_'), safe='')
+
+def read_titles(name):
+    with io.open(name, 'r', encoding='utf8') as file:
+        lines = [line.strip() for line in file]
+    return [line for line in lines if line and not line.startswith('#')]
+
+def state_path(path, name):
+    # Bookkeeping that belongs to the repository but not to its history.
+    return os.path.join(path, '.git', 'wikimit', name)
+
+def get_info(path):
+    info_name = os.path.join(path, 'info.json')
     if not os.path.exists(info_name):
         return None
     with io.open(info_name, 'r', encoding='utf8') as file:
         return json.loads(file.read())
 
-def add_commits(path, info, commits):
-    for commit in commits:
-        update_files(info, commit)
-        git_commit(commit)
-
-def first_setup(info):
-    git_init()
+def resume_info(path):
+    # info.json is only rewritten by the last commit of each batch, so after
+    # an interrupted run HEAD can be ahead of it, and the subprocess backend
+    # can leave a revision half staged. Resets the work tree to HEAD and
+    # continues from the newest revision committed there.
+    if not get_info(path):
+        return None
+    git_reset_hard(path)
+    info = info_from_json(get_info(path))
+    revision_id, timestamp = git_head_revision(path)
+    found = revision_index(path).find_commit(git_rev_parse(path, 'HEAD'))
+    if found and found[0] != revision_id:
+        print('Revision index maps HEAD to revision {}, trusting HEAD\'s {}'.format(found[0], revision_id))
+    if revision_id and revision_id != info.synced_revision_id:
+        print('Resuming from revision {} found at HEAD'.format(revision_id))
+        info.synced_revision_id = revision_id
+        info.synced_revision_timestamp = timestamp
+    return info
+
+BACKENDS = ('fast-import', 'subprocess')
+
+def add_commits(path, info, commits, backend='fast-import', importer=None):
+    # importer is an open FastImportSession to add the batch to instead.
+    if importer:
+        return importer.add(info, commits)
+    if backend == 'fast-import':
+        return add_commits_fast_import(path, info, commits)
+    elif backend == 'subprocess':
+        return add_commits_subprocess(path, info, commits)
+    else:
+        raise ValueError('Unknown backend: {}'.format(backend))
+
+def add_commits_subprocess(path, info, commits):
+    count = 0
+    previous = None
+    edits = EditTracker(state_path(path, 'edits.jsonl'), git_show(path, 'HEAD:article.xml'))
+    rows = []
+    try:
+        for commit, last in mark_last(commits):
+            edits.measure(commit)
+            # null edits keep the same text, so the article needn't be rewritten
+            sha1 = commit.sha1
+            update_files(path, info, commit, article=not sha1 or sha1 != previous, checkpoint=last)
+            previous = sha1
+            git_commit(path, commit)
+            rows.append(index_row(info.title, commit))
+            count += 1
+            count_metric('revisions_committed')
+            count_metric('bytes_committed', len(commit.content))
+        edits.flush()
+    finally:
+        # commits that landed are indexed even when the batch is cut short,
+        # since the rerun resumes after them
+        index_commits(path, rows)
+    return count
+
+def add_commits_fast_import(path, info, commits):
+    # Streams the whole batch through one git fast-import process, producing
+    # the same commits as add_commits_subprocess without touching the index.
+    with span('git fast-import'), FastImportSession(path) as importer:
+        return importer.add(info, commits)
+
+# Commits written between ref updates in a long-lived import.
+IMPORT_CHECKPOINT = 10000
+# Texts remembered per page for reverts. blobs.json is rewritten after every
+# batch, so it has to stay small however long the history gets.
+PAGE_BLOB_WINDOW = 1000
+
+class FastImportSession:
+    # A git fast-import process for one page, kept open for as many batches
+    # as the caller likes. fast-import writes objects straight into a pack,
+    # storing each blob as a delta against the one before it, so consecutive
+    # article versions compress against each other. Keeping the session open
+    # for a whole import leaves a single pack and checks out the final tree
+    # only once. Refs are updated every IMPORT_CHECKPOINT commits, at a batch
+    # boundary so info.json matches, and an interrupted import resumes from
+    # there.
+
+    def __init__(self, path):
+        self.path = path
+        self.blobs = BlobMap(
+            name=state_path(path, 'blobs.json'),
+            current=git_rev_parse(path, 'HEAD:article.xml'),
+            window=PAGE_BLOB_WINDOW)
+        self.edits = EditTracker(state_path(path, 'edits.jsonl'), git_show(path, 'HEAD:article.xml'))
+        self.fast_import = GitFastImport(path, marks=state_path(path, 'marks'))
+        self.since_checkpoint = 0
+        self.rows = []
+        self.checkpointed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return
+        self.close()
+
+    def add(self, info, commits):
+        count = 0
+        for commit, last in mark_last(commits):
+            count += 1
+            count_metric('revisions_committed')
+            count_metric('bytes_committed', len(commit.content))
+            update_info(info, commit)
+            self.edits.measure(commit)
+            # info.json is checkpointed by the batch's last commit only
+            self.fast_import.commit(
+                author=commit.author,
+                date=commit.date,
+                message=git_message(commit),
+                files=[('info.json', info_to_json(info).encode('utf8'))] if last else [],
+                refs=self.blobs.changes(self.fast_import, 'article.xml', commit))
+            self.rows.append(index_row(info.title, commit))
+        self.since_checkpoint += count
+        if self.since_checkpoint >= IMPORT_CHECKPOINT:
+            self.fast_import.checkpoint()
+            self.edits.flush()
+            self.since_checkpoint = 0
+            self.checkpointed = len(self.rows)
+        return count
+
+    def close(self):
+        # The revision index reads commit ids off HEAD, which only catches up
+        # with fast-import once it has exited.
+        self.fast_import.close()
+        self.edits.flush()
+        self.blobs.save(self.fast_import.read_marks())
+        index_commits(self.path, self.rows)
+        git_reset_hard(self.path)
+
+    def abort(self):
+        self.fast_import.abort()
+        index_commits(self.path, self.rows[:self.checkpointed])
+
+# Revisions remembered for revert detection.
+EDIT_REVERT_WINDOW = 20
+
+class EditTracker:
+    # Follows a page's revisions in commit order, measuring each one against
+    # the previous text already in memory and spotting reverts by sha1. The
+    # stats go into the commit description, and once the commits are written
+    # one JSON line per revision is appended to the page's edit index. The
+    # index's last lines carry revert detection over to the next batch.
+    # previous can be a function returning the text, called only once there
+    # is a revision to measure.
+
+    def __init__(self, name, previous=b''):
+        self.name = name
+        self.previous = previous
+        self.recent = deque(maxlen=EDIT_REVERT_WINDOW)
+        self.pending = []
+        if name and os.path.exists(name):
+            for line in read_tail(name, EDIT_REVERT_WINDOW):
+                record = json.loads(line)
+                self.recent.append((record['sha1'], record['id']))
+
+    def measure(self, commit):
+        if callable(self.previous):
+            self.previous = self.previous()
+        stats = edit_stats(self.previous, commit.content)
+        if commit.sha1 and self.recent and commit.sha1 != self.recent[-1][0]:
+            for sha1, revision_id in reversed(self.recent):
+                if sha1 == commit.sha1:
+                    stats['reverts_to'] = revision_id
+                    break
+        commit.stats = stats
+        self.previous = commit.content
+        self.recent.append((commit.sha1, commit.id))
+        record = OrderedDict([('id', commit.id), ('timestamp', commit.timestamp), ('sha1', commit.sha1)])
+        record.update(stats)
+        self.pending.append(json.dumps(record))
+
+    def flush(self):
+        if not self.name or not self.pending:
+            return
+        make_dir(os.path.dirname(self.name))
+        with io.open(self.name, 'a', encoding='utf8') as file:
+            file.write('\n'.join(self.pending) + '\n')
+        self.pending = []
+
+def edit_stats(previous, content):
+    # Trims the common prefix and suffix, then widens the changed middle to
+    # whole lines and counts them. Much cheaper than a real diff, and exact
+    # for the common case of one contiguous edit. Texts are compared a block
+    # at a time through text_range, so spooled text is read back in chunks
+    # and gets the same stats as text held in memory.
+    stats = OrderedDict([
+        ('size', len(content)),
+        ('size_delta', len(content) - len(previous)),
+    ])
+    shortest = min(len(previous), len(content))
+    common = common_prefix(previous, content, shortest)
+    if common == len(previous) == len(content):
+        stats['lines_added'] = stats['lines_removed'] = 0
+        return stats
+    prefix = rfind_newline(previous, common) + 1
+    suffix = common_suffix(previous, content, shortest - prefix)
+    start = len(previous) - suffix
+    if suffix and not (at_line_start(previous, start) and at_line_start(content, len(content) - suffix)):
+        # the suffix is identical in both, so skipping to just past its first
+        # newline lines it up with a line start in both
+        newline = find_newline(previous, start)
+        suffix = len(previous) - newline - 1 if newline != -1 else 0
+    stats['lines_added'] = count_lines(content, prefix, len(content) - suffix)
+    stats['lines_removed'] = count_lines(previous, prefix, len(previous) - suffix)
+    return stats
+
+def text_range(text, start, end):
+    if isinstance(text, SpooledText):
+        return text.read(start, end)
+    return text[start:end]
+
+def common_prefix(a, b, limit):
+    # Length of the common prefix, up to limit: whole blocks are compared
+    # until one differs, which is then bisected with slice compares.
+    position = 0
+    while position < limit:
+        end = min(limit, position + STREAM_CHUNK_SIZE)
+        x, y = text_range(a, position, end), text_range(b, position, end)
+        if x != y:
+            low, high = 0, len(x)
+            while low < high:
+                middle = (low + high + 1) // 2
+                if x[:middle] == y[:middle]:
+                    low = middle
+                else:
+                    high = middle - 1
+            return position + low
+        position = end
+    return limit
+
+def common_suffix(a, b, limit):
+    length = 0
+    while length < limit:
+        size = min(limit - length, STREAM_CHUNK_SIZE)
+        x = text_range(a, len(a) - length - size, len(a) - length)
+        y = text_range(b, len(b) - length - size, len(b) - length)
+        if x != y:
+            low, high = 0, size
+            while low < high:
+                middle = (low + high + 1) // 2
+                if x[size - middle:] == y[size - middle:]:
+                    low = middle
+                else:
+                    high = middle - 1
+            return length + low
+        length += size
+    return limit
+
+def rfind_newline(text, end):
+    # Position of the last newline before end, or -1.
+    while end > 0:
+        start = max(0, end - STREAM_CHUNK_SIZE)
+        found = text_range(text, start, end).rfind(b'\n')
+        if found != -1:
+            return start + found
+        end = start
+    return -1
+
+def find_newline(text, start):
+    # Position of the first newline from start on, or -1.
+    while start < len(text):
+        end = min(len(text), start + STREAM_CHUNK_SIZE)
+        found = text_range(text, start, end).find(b'\n')
+        if found != -1:
+            return start + found
+        start = end
+    return -1
+
+def at_line_start(text, position):
+    return position == 0 or text_range(text, position - 1, position) == b'\n'
+
+def count_lines(text, start, end):
+    count = 0
+    last = b''
+    for position in range(start, end, STREAM_CHUNK_SIZE):
+        block = text_range(text, position, min(end, position + STREAM_CHUNK_SIZE))
+        count += block.count(b'\n')
+        last = block[-1:]
+    return count + (1 if last and last != b'\n' else 0)
+
+def read_tail(name, count, block=64 * 1024):
+    # The last `count` lines of a file, without reading all of it.
+    with io.open(name, 'rb') as file:
+        file.seek(0, io.SEEK_END)
+        end = file.tell()
+        data = b''
+        while end > 0 and data.count(b'\n') <= count:
+            start = max(0, end - block)
+            file.seek(start)
+            data = file.read(end - start) + data
+            end = start
+    return [line.decode('utf8') for line in data.splitlines()[-count:] if line]
+
+REVISION_INDEX = None
+
+class RevisionIndex:
+    # SQLite table from wiki revisions to the commits that hold them, so
+    # lookups by revision id, contributor, time range or commit don't have to
+    # walk git log. Connections are opened per call, letting worker threads
+    # and processes share one fleet-wide file under SQLite's own locking.
+
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS revisions (
+            revision_id INTEGER PRIMARY KEY,
+            page TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            contributor TEXT NOT NULL,
+            contributor_id TEXT NOT NULL,
+            minor INTEGER NOT NULL,
+            sha1 TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            commit_sha TEXT NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS revisions_page_timestamp ON revisions (page, timestamp)',
+        'CREATE INDEX IF NOT EXISTS revisions_contributor ON revisions (contributor)',
+        'CREATE INDEX IF NOT EXISTS revisions_commit ON revisions (commit_sha)',
+    ]
+
+    def __init__(self, name):
+        self.name = name
+
+    @contextlib.contextmanager
+    def connect(self):
+        make_dir(os.path.dirname(os.path.abspath(self.name)))
+        connection = sqlite3.connect(self.name, timeout=60)
+        try:
+            with connection:
+                for statement in self.SCHEMA:
+                    connection.execute(statement)
+                yield connection
+        finally:
+            connection.close()
+
+    def add(self, rows):
+        # rows are index_row tuples followed by the commit sha
+        if not rows:
+            return
+        with span('index'), self.connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO revisions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def find_commit(self, commit_sha):
+        # Returns (revision id, timestamp) for a commit, if it was indexed.
+        if not commit_sha or not os.path.exists(self.name):
+            return None
+        with self.connect() as connection:
+            row = connection.execute(
+                'SELECT revision_id, timestamp FROM revisions WHERE commit_sha = ?', (commit_sha,)).fetchone()
+        return (str(row[0]), row[1]) if row else None
+
+def index_row(title, commit):
+    return (
+        int(commit.id),
+        title,
+        commit.timestamp,
+        commit.contributor_username or commit.contributor_ip,
+        commit.contributor_id,
+        1 if commit.minor else 0,
+        commit.sha1,
+        len(commit.content),
+    )
+
+def index_commits(path, rows):
+    # rows are index_row tuples for the newest commits on HEAD, oldest first.
+    # Each is matched against the revision id in its commit's message, so
+    # rows for commits that never made it to HEAD are left out.
+    if not rows:
+        return
+    shas = {revision_id: sha for sha, revision_id in git_log_revisions(path, len(rows))}
+    matched = [row + (shas[str(row[0])],) for row in rows if str(row[0]) in shas]
+    if len(matched) != len(rows):
+        print('Indexed {} of {} revisions, the rest are not at HEAD'.format(len(matched), len(rows)))
+    revision_index(path).add(matched)
+
+def revision_index(path):
+    # The fleet-wide index when one is set, otherwise the repository's own.
+    return REVISION_INDEX or RevisionIndex(state_path(path, 'revisions.sqlite'))
+
+def set_revision_index(name):
+    global REVISION_INDEX
+    REVISION_INDEX = RevisionIndex(name) if name else None
+
+def mark_last(iterable):
+    # Yields (item, is_last) pairs, looking one item ahead.
+    iterator = iter(iterable)
+    try:
+        item = next(iterator)
+    except StopIteration:
+        return
+    for following in iterator:
+        yield item, False
+        item = following
+    yield item, True
+
+class BlobMap:
+    # Remembers which git blob already holds each revision's text, keyed by
+    # the sha1 the wiki reports. Reverts then point at the existing blob
+    # instead of sending the text again, and revisions that leave the text
+    # unchanged don't touch the article at all. With a window only the most
+    # recently seen texts are kept, which still catches most reverts.
+
+    def __init__(self, name=None, current='', window=None):
+        self.name = name
+        self.current = current
+        self.window = window
+        self.blobs = OrderedDict()
+        self.pending = {}
+        if name and os.path.exists(name):
+            with io.open(name, 'r', encoding='utf8') as file:
+                self.blobs.update(json.load(file))
+            # saved least recently used first, so a smaller window keeps the newest
+            while window and len(self.blobs) > window:
+                self.blobs.popitem(last=False)
+
+    def changes(self, fast_import, name, commit):
+        # Returns the file changes needed to put this revision's text at name.
+        sha1 = commit.sha1
+        ref = self.lookup(sha1)
+        if ref is None:
+            ref = fast_import.blob(commit.content)
+            if sha1:
+                self.remember(sha1, ref)
+        elif ref == self.current:
+            return []
+        self.current = ref
+        return [(name, ref)]
+
+    def lookup(self, sha1):
+        if not sha1:
+            return None
+        ref = self.blobs.get(sha1)
+        if ref is not None and self.window:
+            self.blobs.move_to_end(sha1)
+        return ref
+
+    def remember(self, sha1, ref):
+        self.blobs[sha1] = ref
+        self.pending[sha1] = ref
+        if self.window and len(self.blobs) > self.window:
+            self.blobs.popitem(last=False)
+
+    def save(self, marks):
+        # Swaps fast-import marks for the blob ids they resolved to.
+        for sha1, ref in self.pending.items():
+            if sha1 in self.blobs:
+                self.blobs[sha1] = marks.get(ref, ref)
+        if self.current in marks:
+            self.current = marks[self.current]
+        self.pending = {}
+        if self.name:
+            make_dir(os.path.dirname(self.name))
+            with io.open(self.name, 'w', encoding='utf8') as file:
+                json.dump(self.blobs, file)
+
+def first_setup(path, info):
+    git_init(path)
 
     article_name = 'article.xml'
     info_name = 'info.json'
@@ -133,37 +1875,48 @@ def first_setup(info):
     info.synced_revision_timestamp = ''
     info.last_sync = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
 
-    with io.open(article_name, 'w', encoding='utf8') as file:
+    with io.open(os.path.join(path, article_name), 'w', encoding='utf8') as file:
         pass
-    with io.open(info_name, 'w', encoding='utf8') as file:
-        file.write(json.dumps(info, cls=EnhancedJSONEncoder, indent=4))
-    with io.open(readme_name, 'w', encoding='utf8') as file:
+    with io.open(os.path.join(path, info_name), 'w', encoding='utf8') as file:
+        file.write(info_to_json(info))
+    with io.open(os.path.join(path, readme_name), 'w', encoding='utf8') as file:
         file.write(README_TEMPLATE.format(info.title, info.url))
-    with io.open(license_name, 'w', encoding='utf8') as file:
+    with io.open(os.path.join(path, license_name), 'w', encoding='utf8') as file:
         file.write(LICENSE_CC_BY_SA)
 
-    git_add(article_name)
-    git_add(info_name)
-    git_add(readme_name)
-    git_add(license_name)
+    git_add(path, article_name)
+    git_add(path, info_name)
+    git_add(path, readme_name)
+    git_add(path, license_name)
 
-    git_commit_initial()
+    git_commit_initial(path)
 
-def update_files(info, commit):
+def update_files(path, info, commit, article=True, checkpoint=True):
     article_name = 'article.xml'
     info_name = 'info.json'
 
-    info.synced_revision_id = commit.info['id']
+    update_info(info, commit)
+
+    with span('write files'):
+        if article:
+            with io.open(os.path.join(path, article_name), 'wb') as file:
+                write_content(file, commit.content)
+        if checkpoint:
+            with io.open(os.path.join(path, info_name), 'w', encoding='utf8') as file:
+                file.write(info_to_json(info))
+
+    if article:
+        git_add(path, article_name)
+    if checkpoint:
+        git_add(path, info_name)
+
+def update_info(info, commit):
+    info.synced_revision_id = commit.id
     info.synced_revision_timestamp = commit.date
     info.last_sync = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
 
-    with io.open(article_name, 'w', encoding='utf8') as file:
-        file.write(commit.content)
-    with io.open(info_name, 'w', encoding='utf8') as file:
-        file.write(json.dumps(info, cls=EnhancedJSONEncoder, indent=4))
-
-    git_add(article_name)
-    git_add(info_name)
+def info_to_json(info):
+    return json.dumps(info, cls=EnhancedJSONEncoder, indent=4)
 
 # git
 
@@ -191,106 +1944,688 @@ def git_check_min_version():
 
     print(git_version_info)
 
-def git_repo_root():
+def git_repo_root(path):
     return subprocess.Popen([
         'git',
         'rev-parse',
         '--show-toplevel'
-    ], stdout=subprocess.PIPE).communicate()[0].rstrip().decode('utf-8')
+    ], stdout=subprocess.PIPE, cwd=path).communicate()[0].rstrip().decode('utf-8')
 
-def git_init():
+def git_init(path):
     subprocess.Popen([
         'git',
         'init',
         '--initial-branch', 'main',
-    ], stdout=subprocess.PIPE).communicate()
+    ], stdout=subprocess.PIPE, cwd=path).communicate()
 
-def git_add(name):
-    subprocess.Popen([
-        'git',
-        'add',
-        name,
-    ], stdout=subprocess.PIPE).communicate()
+def git_add(path, name):
+    with span('git add'):
+        subprocess.Popen([
+            'git',
+            'add',
+            name,
+        ], stdout=subprocess.PIPE, cwd=path).communicate()
 
-def git_commit_initial():
+def git_commit_initial(path):
     subprocess.Popen([
         'git',
         'commit',
         '-m', 'Initial commit'
-    ], stdout=subprocess.PIPE).communicate()
+    ], stdout=subprocess.PIPE, cwd=path).communicate()
+
+def git_commit(path, commit):
+    with span('git commit'):
+        process = subprocess.Popen([
+            'git',
+            'commit',
+            # null edits in the middle of a batch change no files
+            '--allow-empty',
+            '-m', commit.message,
+            '-m', commit.description,
+            '--date', commit.date,
+            '--author', commit.author
+        ], stdout=subprocess.PIPE, cwd=path)
+        process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError('git commit failed for revision {} with exit code {}'.format(commit.id, process.returncode))
+
+def git_rev_parse(path, rev):
+    out, err = subprocess.Popen([
+        'git',
+        'rev-parse',
+        '--verify',
+        '--quiet',
+        rev,
+    ], stdout=subprocess.PIPE, cwd=path).communicate()
+    return out.rstrip().decode('utf-8')
 
-def git_commit(commit):
-    subprocess.Popen([
+def git_var(path, name):
+    return subprocess.Popen([
         'git',
-        'commit',
-        '-m', commit.message,
-        '-m', commit.description,
-        '--date', commit.date,
-        '--author', commit.author
-    ], stdout=subprocess.PIPE).communicate()
+        'var',
+        name,
+    ], stdout=subprocess.PIPE, cwd=path).communicate()[0].rstrip().decode('utf-8')
+
+def git_ls_tree(path, rev, prefix):
+    # Maps each file under prefix to its blob id in one call.
+    out, err = subprocess.Popen([
+        'git',
+        'ls-tree',
+        '-r',
+        '-z',
+        rev,
+        '--',
+        prefix,
+    ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=path).communicate()
+    blobs = {}
+    for entry in out.decode('utf-8').split('\0'):
+        if entry:
+            meta, name = entry.split('\t', 1)
+            blobs[name] = meta.split()[2]
+    return blobs
+
+def git_head_revision(path):
+    # Reads the wiki revision id and timestamp back from the description
+    # git_commit wrote for HEAD. The description follows the edit summary,
+    # so the last matching lines win.
+    out, err = subprocess.Popen([
+        'git',
+        'log',
+        '-1',
+        '--format=%B',
+    ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=path).communicate()
+    return message_revision(out.decode('utf-8'))
+
+def git_log_revisions(path, count):
+    # [(commit sha, wiki revision id)] for the newest `count` commits on
+    # HEAD, newest first.
+    out, err = subprocess.Popen([
+        'git',
+        'log',
+        '--max-count={}'.format(count),
+        '--format=%H%n%B%x00',
+    ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=path).communicate()
+    revisions = []
+    for entry in out.decode('utf-8').split('\0'):
+        sha, sep, message = entry.strip('\n').partition('\n')
+        if sha:
+            revisions.append((sha, message_revision(message)[0]))
+    return revisions
+
+def message_revision(message):
+    fields = {}
+    for line in message.splitlines():
+        key, sep, value = line.partition(': ')
+        if sep and key in ('id', 'timestamp'):
+            fields[key] = value
+    return fields.get('id', ''), fields.get('timestamp', '')
+
+def git_repack(path, window, depth):
+    with span('git repack'):
+        subprocess.Popen([
+            'git',
+            'repack',
+            '-a',
+            '-d',
+            '-f',
+            '-q',
+            '--window={}'.format(window),
+            '--depth={}'.format(depth),
+        ], stdout=subprocess.PIPE, cwd=path).communicate()
+
+def git_count_objects(path):
+    # count/size are loose objects, in-pack/size-pack packed ones; sizes in KB
+    out, err = subprocess.Popen([
+        'git',
+        'count-objects',
+        '-v',
+    ], stdout=subprocess.PIPE, cwd=path).communicate()
+    stats = {}
+    for line in out.decode('utf-8').splitlines():
+        key, sep, value = line.partition(': ')
+        if sep and value.isdigit():
+            stats[key] = int(value)
+    return stats
+
+def git_object_bytes(path):
+    # Total uncompressed size of every object in the repository.
+    out, err = subprocess.Popen([
+        'git',
+        'cat-file',
+        '--batch-all-objects',
+        '--batch-check=%(objectsize)',
+    ], stdout=subprocess.PIPE, cwd=path).communicate()
+    return sum(int(line) for line in out.split())
+
+def git_show(path, rev):
+    # Contents of a blob, or b'' when rev doesn't name one.
+    out, err = subprocess.Popen([
+        'git',
+        'cat-file',
+        'blob',
+        rev,
+    ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=path).communicate()
+    return out
+
+def git_reset_hard(path):
+    with span('git reset'):
+        subprocess.Popen([
+            'git',
+            'reset',
+            '--hard',
+            '--quiet',
+        ], stdout=subprocess.PIPE, cwd=path).communicate()
+
+def git_message(commit):
+    # Mirrors what `git commit -m message -m description` stores, which
+    # applies the 'whitespace' cleanup mode to the joined paragraphs.
+    lines = []
+    for line in '{}\n\n{}'.format(commit.message, commit.description).split('\n'):
+        line = line.rstrip(' \t\r\v\f')
+        if line or (lines and lines[-1]):
+            lines.append(line)
+    while lines and not lines[-1]:
+        lines.pop()
+    return '\n'.join(lines) + '\n' if lines else ''
+
+def git_raw_date(date):
+    return '{} +0000'.format(parse_timestamp(date))
+
+class GitFastImport:
+    # See the input format here:
+    # https://git-scm.com/docs/git-fast-import
+
+    def __init__(self, path, ref='refs/heads/main', marks=None):
+        self.ref = ref
+        self.parent = git_rev_parse(path, ref)
+        self.committer = git_var(path, 'GIT_COMMITTER_IDENT')
+        self.marks = marks
+        self.mark = 0
+        args = [
+            'git',
+            'fast-import',
+            '--quiet',
+            '--date-format=raw',
+        ]
+        if marks:
+            make_dir(os.path.dirname(marks))
+            args.append('--export-marks={}'.format(os.path.abspath(marks)))
+        # stdout only carries replies to progress commands, see checkpoint
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=path)
+        self.stream = self.process.stdin
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return
+        self.close()
+
+    def blob(self, content):
+        # Sends content once and returns a mark that commits can refer to.
+        self.mark += 1
+        self.write('blob\nmark :{}\n'.format(self.mark))
+        self.data(content)
+        return ':{}'.format(self.mark)
+
+    def commit(self, author, date, message, files, refs=()):
+        self.write('commit {}\n'.format(self.ref))
+        self.write('author {} {}\n'.format(author, git_raw_date(date)))
+        self.write('committer {}\n'.format(self.committer))
+        self.data(message.encode('utf8'))
+        if self.parent:
+            # fast-import continues the branch on its own after the first commit
+            self.write('from {}\n'.format(self.parent))
+            self.parent = None
+        for name, content in files:
+            self.write('M 100644 inline {}\n'.format(name))
+            self.data(content)
+        for name, ref in refs:
+            self.write('M 100644 {} {}\n'.format(ref, name))
+        self.write('\n')
+
+    def data(self, content):
+        self.write('data {}\n'.format(len(content)))
+        write_content(self.stream, content)
+        self.stream.write(b'\n')
+
+    def write(self, text):
+        self.stream.write(text.encode('utf8'))
+
+    def checkpoint(self):
+        # Makes everything imported so far durable and updates the ref, and
+        # waits until fast-import has done so: commands are handled in
+        # order, so the progress reply only comes once the checkpoint is.
+        self.write('checkpoint\n\nprogress checkpoint\n\n')
+        self.stream.flush()
+        reply = self.process.stdout.readline()
+        if reply != b'progress checkpoint\n':
+            raise RuntimeError('git fast-import failed to checkpoint: {!r}'.format(reply))
+
+    def close(self):
+        self.stream.close()
+        self.process.stdout.close()
+        if self.process.wait() != 0:
+            raise RuntimeError('git fast-import failed with exit code {}'.format(self.process.returncode))
+
+    def abort(self):
+        # Drops everything since the last checkpoint, leaving the ref alone.
+        # stdin is closed only once the process is gone, as an EOF would let
+        # fast-import finish the import.
+        self.process.kill()
+        self.process.wait()
+        with contextlib.suppress(BrokenPipeError):
+            self.stream.close()
+        self.process.stdout.close()
+
+    def read_marks(self):
+        # Maps each mark to the object id fast-import gave it; only valid
+        # once the process has exited.
+        marks = {}
+        if not self.marks or not os.path.exists(self.marks):
+            return marks
+        with io.open(self.marks, 'r', encoding='utf8') as file:
+            for line in file:
+                mark, sha = line.split()
+                marks[mark] = sha
+        return marks
 
 # convert
 
 def parse_current(current):
-    doc = xml.dom.minidom.parseString(current)
-    page = doc.getElementsByTagName('page')[0]
-    revision = doc.getElementsByTagName('revision')[0]
-    title = getChildText(page, 'title')
-    url = '{}/wiki/{}'.format(WIKI_BASE, title)
+    for page, revision in iter_export([current]):
+        return revision_to_info(page, revision)
+    raise ValueError('Export contains no revisions')
+
+def parse_current_many(chunks):
+    # Returns {title: PageInfo} for a multi-page curonly export, keeping only
+    # metadata; each revision is dropped as soon as it has been read.
+    infos = OrderedDict()
+    for page, revision in iter_export(chunks):
+        info = revision_to_info(page, revision)
+        infos[info.title] = info
+    return infos
+
+def revision_to_info(page, revision):
+    return new_page_info(
+        getChildText(page, 'id'),
+        getChildText(page, 'title'),
+        getChildText(revision, 'id'),
+        getChildText(revision, 'timestamp'))
+
+def new_page_info(page_id, title, revision_id, revision_timestamp):
     return PageInfo(
-        id=getChildText(page, 'id'),
-        url=url,
+        id=page_id,
+        url='{}/wiki/{}'.format(WIKI_BASE, title),
         title=title,
         language='en',
-        highest_known_revision_id=getChildText(revision, 'id'),
-        highest_known_revision_timestamp=getChildText(revision, 'timestamp'),
+        highest_known_revision_id=revision_id,
+        highest_known_revision_timestamp=revision_timestamp,
         synced_revision_id='',
         synced_revision_timestamp='',
         last_sync='')
 
+def info_from_json(data):
+    return PageInfo(**{field.name: data.get(field.name, '') for field in dataclasses.fields(PageInfo)})
+
 def parse_history(history):
-    doc = xml.dom.minidom.parseString(history)
-    revisions = doc.getElementsByTagName('revision')
-    return [revision_to_commit(r) for r in revisions]
+    return list(iter_history([history]))
+
+def iter_history(chunks):
+    for page, revision in iter_export(chunks):
+        yield revision_to_commit(revision)
+
+def iter_export(chunks):
+    # Incrementally parses Special:Export XML fed as an iterable of byte chunks,
+    # yielding (page, revision) elements as each revision closes. Revisions are
+    # detached once consumed so memory is bounded by a single revision, and
+    # with SPOOL_THRESHOLD set, by the threshold. A whole response is fed in
+    # blocks too, or its entire tree would be built before the first event.
+    if SPOOL_THRESHOLD is None:
+        parser = xml.etree.ElementTree.XMLPullParser(events=('start', 'end'))
+        read_events = parser.read_events
+    else:
+        builder = SpoolingBuilder(SPOOL_THRESHOLD)
+        parser = xml.etree.ElementTree.XMLParser(target=builder)
+        read_events = builder.read_events
+    chunks = iter_blocks(chunks, STREAM_CHUNK_SIZE)
+    stack = []
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is None:
+            parser.close()
+        else:
+            parser.feed(chunk)
+        for event, elem in read_events():
+            if event == 'start':
+                stack.append(elem)
+                continue
+            stack.pop()
+            elem.tag = localName(elem.tag)
+            if elem.tag == 'revision':
+                yield stack[-1], elem
+                stack[-1].remove(elem)
+            elif elem.tag == 'page':
+                stack[-1].remove(elem)
+
+def iter_blocks(chunks, size):
+    # Splits chunks into pieces of at most size bytes without copying.
+    for chunk in chunks:
+        if len(chunk) <= size:
+            yield chunk
+            continue
+        view = memoryview(chunk)
+        for start in range(0, len(view), size):
+            yield view[start:start + size]
 
 def revision_to_commit(revision):
-    contributor = revision.getElementsByTagName('contributor')[0]
-    contributor_username = getChildText(contributor, 'username')
-    contributor_id = getChildText(contributor, 'id')
-    contributor_ip = getChildText(contributor, 'ip')
-
-    message = getChildText(revision, 'comment')
-    author = '{} <{}>'.format(contributor_username, contributor_id) if contributor_username else '{} <IP>'.format(contributor_ip)
-    date = getChildText(revision, 'timestamp')
-    info = OrderedDict([
-        ('id', getChildText(revision, 'id')),
-        ('timestamp', date),
-        ('contributor_username', contributor_username),
-        ('contributor_id', contributor_id),
-        ('contributor_ip', contributor_ip),
-        ('minor', 'True' if hasChild(revision, 'minor') else 'False'),
-        ('model', getChildText(revision, 'model')),
-        ('format', getChildText(revision, 'format')),
-        ('sha1', getChildText(revision, 'sha1')),
-    ])
-    description = '\n'.join(['{}: {}'.format(k, v) for k, v in info.items() if v])
+    contributor = revision.find('contributor')
+    text = revision.find('text')
+    content = text.text if text is not None and text.text else b''
+    if isinstance(content, str):
+        content = content.encode('utf8')
+    if text is not None:
+        # the element is discarded with the revision, but drop the str now
+        # so only the encoded copy stays alive
+        text.text = None
     return Commit(
-        message=message if message else '.',
-        author=author,
-        description=description,
-        content=getChildText(revision, 'text'),
-        date=date,
-        info=info)
+        id=getChildText(revision, 'id'),
+        timestamp=getChildText(revision, 'timestamp'),
+        contributor_username=getChildText(contributor, 'username'),
+        contributor_id=getChildText(contributor, 'id'),
+        contributor_ip=getChildText(contributor, 'ip'),
+        minor=hasChild(revision, 'minor'),
+        model=getChildText(revision, 'model'),
+        format=getChildText(revision, 'format'),
+        sha1=getChildText(revision, 'sha1'),
+        comment=getChildText(revision, 'comment'),
+        content=content)
+
+# Revision text over this many bytes is spooled to a temporary file, or
+# None to keep all text in memory.
+SPOOL_THRESHOLD = None
+
+def set_spool_threshold(size):
+    global SPOOL_THRESHOLD
+    SPOOL_THRESHOLD = size
+
+class SpoolingBuilder:
+    # Parser target for iter_export that builds elements like TreeBuilder,
+    # except that <text> is encoded in blocks as it arrives and set as bytes,
+    # moving to a SpooledText once it passes the threshold. The text is then
+    # never joined into one string, and a huge revision takes no more memory
+    # than the threshold.
+
+    def __init__(self, threshold):
+        self.builder = xml.etree.ElementTree.TreeBuilder()
+        self.threshold = threshold
+        self.events = []
+        # expat hands over text split at every newline and entity, so it's
+        # collected by list.append and only looked at between feeds
+        self.pending = []
+        self.data = self.pending.append
+        self.in_text = False
+        self.chunks = []
+        self.size = 0
+        self.spool = None
+
+    def start(self, tag, attrs):
+        self.pass_data()
+        elem = self.builder.start(tag, attrs)
+        self.events.append(('start', elem))
+        self.in_text = localName(tag) == 'text'
+        return elem
+
+    def end(self, tag):
+        if self.in_text:
+            self.flush()
+        else:
+            self.pass_data()
+        elem = self.builder.end(tag)
+        if self.in_text:
+            elem.text = self.spool if self.spool is not None else b''.join(self.chunks)
+            self.in_text = False
+            self.chunks = []
+            self.size = 0
+            self.spool = None
+        self.events.append(('end', elem))
+        return elem
+
+    def pass_data(self):
+        if self.pending:
+            self.builder.data(''.join(self.pending))
+            del self.pending[:]
+
+    def flush(self):
+        data = ''.join(self.pending).encode('utf8')
+        del self.pending[:]
+        self.size += len(data)
+        if self.spool is None and self.size > self.threshold:
+            self.spool = SpooledText()
+            for chunk in self.chunks:
+                self.spool.write(chunk)
+            self.chunks = []
+        if self.spool is not None:
+            self.spool.write(data)
+        elif data:
+            self.chunks.append(data)
+
+    def close(self):
+        return self.builder.close()
+
+    def read_events(self):
+        # called after every feed, which keeps pending text to one chunk
+        if self.in_text:
+            self.flush()
+        events, self.events = self.events, []
+        return events
+
+class SpooledText:
+    # Revision text kept in an anonymous temporary file, which goes away
+    # with the commit holding it. Only its length is known without reading
+    # it back: write_content copies it out in chunks, and edit_stats reads
+    # the ranges it compares.
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def read(self, start, end):
+        self.file.seek(start)
+        return self.file.read(end - start)
+
+    def copy_to(self, stream):
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, stream, STREAM_CHUNK_SIZE)
+
+def write_content(stream, content):
+    if isinstance(content, SpooledText):
+        content.copy_to(stream)
+    else:
+        stream.write(content)
 
 # wiki
 
-def download_history(title, current=False, offset=1, limit=5):
+STREAM_CHUNK_SIZE = 64 * 1024
+
+WIKI_RATE_LIMITER = None
+
+class RateLimiter:
+    # Token bucket shared by every thread talking to WIKI_BASE. Callers
+    # reserve a token under the lock and sleep off any deficit outside it.
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+def set_rate_limit(rate, burst=1):
+    global WIKI_RATE_LIMITER
+    WIKI_RATE_LIMITER = RateLimiter(rate, burst) if rate else None
+
+def wait_for_rate_limit():
+    if WIKI_RATE_LIMITER:
+        WIKI_RATE_LIMITER.acquire()
+
+WIKI_SESSION = None
+WIKI_SESSION_LOCK = threading.Lock()
+
+WIKI_TIMEOUT = (10, 300)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 300.0
+
+def get_session():
+    # One keep-alive session for every request to WIKI_BASE, so batches reuse
+    # pooled TCP+TLS connections instead of handshaking each time.
+    global WIKI_SESSION
+    with WIKI_SESSION_LOCK:
+        if WIKI_SESSION is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=64)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip'
+            session.headers['User-Agent'] = 'wikimit (https://github.com/davidtorosyan/wikimit)'
+            WIKI_SESSION = session
+        return WIKI_SESSION
+
+def wiki_request(method, url, **kwargs):
+    # Retries connection errors and transient statuses with exponential
+    # backoff, preferring the server's Retry-After when it sends one.
+    session = get_session()
+    for attempt in itertools.count():
+        wait_for_rate_limit()
+        try:
+            with span('request'):
+                response = session.request(method, url, timeout=WIKI_TIMEOUT, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            if attempt >= MAX_RETRIES:
+                raise
+            delay = backoff_delay(attempt)
+            reason = repr(error)
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt >= MAX_RETRIES:
+                response.raise_for_status()
+                count_metric('wiki_requests')
+                return response
+            delay = retry_after(response)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            reason = 'HTTP {}'.format(response.status_code)
+            response.close()
+        count_metric('wiki_retries')
+        print('{} from wikipedia, retrying in {:.1f} seconds...'.format(reason, delay))
+        time.sleep(delay)
+
+def backoff_delay(attempt):
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+def retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            when = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        delay = (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+    return min(BACKOFF_MAX, max(0.0, delay))
+
+def count_response_bytes(response, decoded):
+    # raw.tell() is the number of (possibly gzipped) bytes read off the socket
+    count_metric('wiki_bytes_over_wire', response.raw.tell())
+    count_metric('wiki_bytes_decoded', decoded)
+
+def iter_response(response):
+    decoded = 0
+    try:
+        for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            decoded += len(chunk)
+            yield chunk
+    finally:
+        count_response_bytes(response, decoded)
+        response.close()
+
+def connection_stats():
+    if WIKI_SESSION is None:
+        return 0, 0
+    connections, requests_sent = 0, 0
+    adapters = {id(adapter): adapter for adapter in WIKI_SESSION.adapters.values()}
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+    return connections, requests_sent
+
+def print_wiki_stats():
+    counters = METRICS.snapshot()['counters']
+    if not counters.get('wiki_requests'):
+        return
+    connections, requests_sent = connection_stats()
+    print('wiki made {} requests ({} retries) over {} connections ({} reused)'.format(
+        counters['wiki_requests'], counters.get('wiki_retries', 0), connections, max(0, requests_sent - connections)))
+    print('wiki transferred {:.2f} MB over the wire for {:.2f} MB of XML'.format(
+        counters.get('wiki_bytes_over_wire', 0) / 1e6, counters.get('wiki_bytes_decoded', 0) / 1e6))
+
+def download_category_members(category):
+    # See parameters here:
+    # https://www.mediawiki.org/wiki/API:Categorymembers
+    url = '{}/w/api.php'.format(WIKI_BASE)
+    params = {
+        'action': 'query',
+        'list': 'categorymembers',
+        'cmtitle': category if category.startswith('Category:') else 'Category:{}'.format(category),
+        'cmnamespace': 0,
+        'cmlimit': 'max',
+        'format': 'json',
+    }
+    titles = []
+    while True:
+        data = wiki_request('GET', url, params=params).json()
+        titles.extend(member['title'] for member in data['query']['categorymembers'])
+        if 'continue' not in data:
+            return titles
+        params.update(data['continue'])
+
+def download_history(title, current=False, offset=1, limit=5, stream=False):
+    if WIKI_CACHE:
+        cached = WIKI_CACHE.get(title, current, offset, limit, stream)
+        if cached is not None:
+            return cached
+    # title can also be a list of titles, exported together.
     # See parameters here:
     # https://www.mediawiki.org/wiki/Manual:Parameters_to_Special:Export
     url = '{}/w/index.php'.format(WIKI_BASE)
     params = {
         'title': 'Special:Export',
-        'pages': title,
+        'pages': title if isinstance(title, str) else '\n'.join(title),
         'action': 'submit',
     }
     if current:
@@ -298,25 +2633,192 @@ def download_history(title, current=False, offset=1, limit=5):
     else:
         params['offset'] = offset
         params['limit'] = limit
-    response = requests.post(url, params=params)
-    return response.content
+    response = wiki_request('POST', url, params=params, stream=stream)
+    if stream:
+        chunks = iter_response(response)
+        return WIKI_CACHE.put_chunks(title, current, offset, limit, chunks) if WIKI_CACHE else chunks
+    content = response.content
+    count_response_bytes(response, len(content))
+    if WIKI_CACHE:
+        WIKI_CACHE.put(title, current, offset, limit, content)
+    return content
+
+def iter_background(iterable, maxsize=16):
+    # Drains an iterable on a background thread into a bounded queue, so the
+    # producer keeps running while the consumer works without running ahead
+    # by more than maxsize items.
+    items = queue.Queue(maxsize)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as error:
+            put((done, error))
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stopped.set()
+
+# cache
+
+WIKI_CACHE = None
+
+EMPTY_EXPORT = b'<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/"></mediawiki>'
+
+class BatchCache:
+    # Gzipped export responses on disk, stored under a hash of
+    # (title, offset, limit). A small index per title records how many
+    # revisions each cached batch at an offset holds, so a batch that came
+    # back full can be reused whatever limit is asked for next time.
+    #
+    # In replay mode nothing goes to the network: any cached batch at the
+    # requested offset is used, the latest cached current revision stands in
+    # for curonly exports, and a missing batch reads as the end of history.
+
+    def __init__(self, root, replay=False):
+        self.root = root
+        self.replay = replay
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, title, current, offset, limit, stream):
+        name = self.lookup(title, current, offset or '', limit)
+        with self.lock:
+            if name:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not name:
+            if not self.replay:
+                return None
+            if current:
+                raise LookupError('No cached current revision for {}'.format(title))
+            content = EMPTY_EXPORT
+        elif stream:
+            return self.iter_file(name)
+        else:
+            with gzip.open(name, 'rb') as file:
+                content = file.read()
+        return iter([content]) if stream else content
+
+    def lookup(self, title, current, offset, limit):
+        if current:
+            name = self.batch_path(title, 'current', None)
+            return name if self.replay and os.path.exists(name) else None
+        batches = self.read_index(title).get(offset, {})
+        candidates = [int(cached) for cached, count in batches.items() if self.replay or count == int(cached)]
+        if limit in candidates:
+            return self.batch_path(title, offset, limit)
+        if candidates:
+            return self.batch_path(title, offset, max(candidates))
+        return None
+
+    def put(self, title, current, offset, limit, content):
+        for chunk in self.put_chunks(title, current, offset, limit, [content]):
+            pass
+
+    def put_chunks(self, title, current, offset, limit, chunks):
+        # Passes streamed chunks through, writing each to a temporary file as
+        # it goes. The batch is only saved once the response has been read to
+        # the end; a response abandoned part way leaves nothing behind.
+        offset = 'current' if current else offset or ''
+        name = self.batch_path(title, offset, None if current else limit)
+        make_dir(os.path.dirname(name))
+        count = 0
+        tail = b''
+        temp_name = '{}.{}.tmp'.format(name, threading.get_ident())
+        try:
+            with gzip.open(temp_name, 'wb') as file:
+                for chunk in chunks:
+                    file.write(chunk)
+                    # Counting across chunk boundaries; article text is escaped
+                    # so only real revision elements can match.
+                    count += (tail + chunk).count(b'<revision>')
+                    tail = chunk[-9:]
+                    yield chunk
+        except BaseException:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            raise
+        os.replace(temp_name, name)
+        if not current:
+            with self.lock:
+                index = self.read_index(title)
+                index.setdefault(offset, {})[str(limit)] = count
+                self.write_index(title, index)
+
+    def iter_file(self, name):
+        with gzip.open(name, 'rb') as file:
+            while True:
+                chunk = file.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    def batch_path(self, title, offset, limit):
+        key = hashlib.sha256(json.dumps([title, offset, limit]).encode('utf8')).hexdigest()
+        return os.path.join(self.root, key[:2], key + '.xml.gz')
+
+    def index_path(self, title):
+        key = hashlib.sha256(title.encode('utf8')).hexdigest()
+        return os.path.join(self.root, 'index', key + '.json')
+
+    def read_index(self, title):
+        name = self.index_path(title)
+        if not os.path.exists(name):
+            return {}
+        with io.open(name, 'r', encoding='utf8') as file:
+            return json.loads(file.read())
+
+    def write_index(self, title, index):
+        name = self.index_path(title)
+        make_dir(os.path.dirname(name))
+        with io.open(name + '.tmp', 'w', encoding='utf8') as file:
+            file.write(json.dumps(index, indent=4, sort_keys=True))
+        os.replace(name + '.tmp', name)
+
+def set_cache(root, replay=False):
+    global WIKI_CACHE
+    WIKI_CACHE = BatchCache(root, replay) if root else None
+
+def print_cache_stats():
+    if WIKI_CACHE:
+        print('cache served {} of {} exports'.format(WIKI_CACHE.hits, WIKI_CACHE.hits + WIKI_CACHE.misses))
 
 # XML helpers
 
+def localName(tag):
+    return tag.rsplit('}', 1)[-1]
+
 def hasChild(node, tag):
-    elems = node.getElementsByTagName(tag)
-    return len(elems) > 0
+    return node is not None and node.find(tag) is not None
 
 def getChildText(node, tag):
-    elems = node.getElementsByTagName(tag)
-    return getText(elems[0].childNodes) if elems else ''
-
-def getText(nodelist):
-    rc = []
-    for node in nodelist:
-        if node.nodeType == node.TEXT_NODE:
-            rc.append(node.data)
-    return ''.join(rc)
+    elem = node.find(tag) if node is not None else None
+    return elem.text or '' if elem is not None else ''
 
 # json
 
@@ -344,6 +2846,22 @@ Like all [Wikipedia derivatives](https://en.wikipedia.org/wiki/Wikipedia:Mirrors
 [Creative Commons Attribution-ShareAlike 4.0 International License](https://creativecommons.org/licenses/by-sa/4.0/).
 """
 
+MONOREPO_README_TEMPLATE = """# Wikipedia pages [wikimit]
+
+## Overview
+
+This repo is a [wikimit](https://github.com/davidtorosyan/wikimit) generated mirror of several Wikipedia pages.
+
+## Usage
+
+Each page lives under `pages/<shard>/<title>/`, with its article and its revision history in `article.xml` and its sync info in `info.json`.
+
+## License
+
+Like all [Wikipedia derivatives](https://en.wikipedia.org/wiki/Wikipedia:Mirrors_and_forks), this repo is licensed under a
+[Creative Commons Attribution-ShareAlike 4.0 International License](https://creativecommons.org/licenses/by-sa/4.0/).
+"""
+
 LICENSE_CC_BY_SA = """Attribution-ShareAlike 4.0 International
 
 =======================================================================
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# Both git backends must write the same history for the same revisions.
+# Runs offline on exports built by bench.py:
+#
+#   python -m unittest discover src
+
+import os
+import os.path
+import re
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+import bench
+import proof
+
+class BackendsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='wikimit-test-')
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+        patch = mock.patch.dict(os.environ, {
+            'GIT_AUTHOR_NAME': 'wikimit-test',
+            'GIT_AUTHOR_EMAIL': 'test@localhost',
+            'GIT_COMMITTER_NAME': 'wikimit-test',
+            'GIT_COMMITTER_EMAIL': 'test@localhost',
+        })
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def export(self, revisions):
+        return bench.export_xml(bench.BENCH_TITLE, bench.BENCH_PAGE_ID, [xml for timestamp, xml in revisions])
+
+    def build(self, backend, export):
+        path = os.path.join(self.workdir, backend)
+        proof.make_dir(path)
+        info = proof.parse_current(export)
+        proof.first_setup(path, info)
+        commits = proof.parse_history(export)
+        proof.add_commits(path, info, commits, backend=backend)
+        # the initial commit is stamped with the wall clock, so leave it out
+        return subprocess.run(
+            ['git', 'log', '-n', str(len(commits)), '--format=%an|%ae|%ad|%B%n%T', '--date=raw'],
+            cwd=path, stdout=subprocess.PIPE, check=True).stdout.decode('utf-8')
+
+    def test_deleted_contributor(self):
+        revisions = bench.generate_revisions(
+            count=6, text_size=500, users=2, ip_fraction=0.3, revert_fraction=0, seed=1)
+        # revision deletion hides the contributor entirely
+        timestamp, xml = revisions[3]
+        revisions[3] = (timestamp, re.sub('<contributor>.*?</contributor>', '<contributor deleted="deleted" />', xml))
+        export = self.export(revisions)
+        logs = [self.build(backend, export) for backend in proof.BACKENDS]
+        self.assertEqual(logs[0], logs[1])
+        self.assertIn('(deleted)|deleted|', logs[0])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+# Kills imports part way through and checks that the revision index only
+# points at commits that exist, and that a rerun picks up every revision.
+# Runs offline against bench.py's stub wiki:
+#
+#   python -m unittest discover src
+
+import os
+import os.path
+import contextlib
+import io
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+import bench
+import proof
+
+REVISIONS = 101
+
+class ResumeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        revisions = bench.generate_revisions(
+            count=REVISIONS, text_size=2000, users=5, ip_fraction=0.3, revert_fraction=0.1, seed=1)
+        cls.wiki = bench.StubWiki(bench.BENCH_TITLE, bench.BENCH_PAGE_ID, revisions)
+        cls.last_id = proof.parse_history(cls.wiki.export())[-1].id
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.wiki.close()
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='wikimit-test-')
+        self.path = os.path.join(self.workdir, proof.title_to_dirname(bench.BENCH_TITLE))
+        patches = [
+            mock.patch.dict(os.environ, {
+                'GIT_AUTHOR_NAME': 'wikimit-test',
+                'GIT_AUTHOR_EMAIL': 'test@localhost',
+                'GIT_COMMITTER_NAME': 'wikimit-test',
+                'GIT_COMMITTER_EMAIL': 'test@localhost',
+            }),
+            mock.patch.object(proof, 'WIKI_BASE', self.wiki.base),
+            mock.patch.object(proof, 'IMPORT_CHECKPOINT', 20),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+
+    def sync(self, **options):
+        with contextlib.redirect_stdout(io.StringIO()):
+            proof.process_all(bench.BENCH_TITLE, self.path, proof.SyncOptions(limit=10, adaptive=False, **options))
+
+    def sync_monorepo(self, titles=(bench.BENCH_TITLE,)):
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            proof.sync_monorepo(list(titles), self.path, proof.SyncOptions(limit=10, adaptive=False))
+        return output.getvalue()
+
+    def sync_failing(self, batches, **options):
+        with self.failing_downloads(batches), self.assertRaises(ConnectionError):
+            self.sync(**options)
+
+    def failing_downloads(self, batches):
+        # Lets `batches` history downloads through, then fails the next one.
+        download_history = proof.download_history
+        calls = []
+
+        def failing(*args, **kwargs):
+            if not kwargs.get('current'):
+                calls.append(args)
+                if len(calls) > batches:
+                    raise ConnectionError('network down')
+            return download_history(*args, **kwargs)
+
+        return mock.patch.object(proof, 'download_history', failing)
+
+    def git(self, *args):
+        return subprocess.run(['git'] + list(args), cwd=self.path, stdout=subprocess.PIPE, check=True).stdout.decode('utf-8')
+
+    def assertIndexMatchesHistory(self):
+        # every indexed sha is a commit on HEAD holding that revision
+        on_head = dict(proof.git_log_revisions(self.path, REVISIONS + 1))
+        with proof.revision_index(self.path).connect() as connection:
+            rows = connection.execute('SELECT revision_id, commit_sha FROM revisions').fetchall()
+        for revision_id, commit_sha in rows:
+            self.assertEqual(on_head.get(commit_sha), str(revision_id))
+        return len(rows)
+
+    def assertFullyImported(self):
+        self.assertEqual(int(self.git('rev-list', '--count', 'HEAD')), REVISIONS + 1)
+        self.assertEqual(proof.git_head_revision(self.path)[0], self.last_id)
+        self.assertEqual(self.assertIndexMatchesHistory(), REVISIONS)
+
+    def test_single_pack_killed_mid_import(self):
+        self.sync_failing(batches=5, single_pack=True)
+        # the import stopped after 50 revisions, at the checkpoint after 40
+        self.assertEqual(int(self.git('rev-list', '--count', 'HEAD')), 40 + 1)
+        self.assertEqual(self.assertIndexMatchesHistory(), 40)
+        self.sync(single_pack=True)
+        self.assertFullyImported()
+
+    def test_single_pack_checkpoint_lost(self):
+        # a checkpoint that never reaches git mustn't be indexed or resumed from
+        with mock.patch.object(proof.GitFastImport, 'checkpoint', lambda self: None):
+            self.sync_failing(batches=5, single_pack=True)
+        self.assertEqual(int(self.git('rev-list', '--count', 'HEAD')), 1)
+        self.assertEqual(self.assertIndexMatchesHistory(), 0)
+        self.sync(single_pack=True)
+        self.assertFullyImported()
+
+    def test_subprocess_killed_mid_batch(self):
+        git_commit = proof.git_commit
+        calls = []
+
+        def failing(path, commit):
+            calls.append(commit)
+            if len(calls) == 35:
+                raise KeyboardInterrupt
+            git_commit(path, commit)
+
+        with mock.patch.object(proof, 'git_commit', failing), self.assertRaises(KeyboardInterrupt):
+            self.sync(backend='subprocess')
+        self.assertEqual(int(self.git('rev-list', '--count', 'HEAD')), 34 + 1)
+        self.assertEqual(self.assertIndexMatchesHistory(), 34)
+        self.sync(backend='subprocess')
+        self.assertFullyImported()
+
+    def test_monorepo_killed_mid_import(self):
+        with mock.patch.object(proof, 'MONOREPO_CHECKPOINT', 7):
+            with self.failing_downloads(batches=5), self.assertRaises(ConnectionError):
+                self.sync_monorepo()
+            # 50 revisions were merged, the last checkpoint came after 49
+            self.assertEqual(int(self.git('rev-list', '--count', 'HEAD')), 49 + 1)
+            self.assertEqual(self.assertIndexMatchesHistory(), 49)
+            self.sync_monorepo()
+        self.assertFullyImported()
+
+    def test_monorepo_skips_missing_title(self):
+        output = self.sync_monorepo([bench.BENCH_TITLE, 'No such page'])
+        self.assertIn('Skipping No such page: page not found', output)
+        self.assertFullyImported()
+
+if __name__ == "__main__":
+    unittest.main()